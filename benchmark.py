@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Load test of the bot's handlers against a local fake Bot API.
+
+Seeds a fresh roaming.db in --workdir with synthetic users, messages and ratings, then lets
+--concurrency virtual users swipe, like, record and publish through the real handlers and
+reports throughput and latency per handler.
+
+    python benchmark.py --users 10000 --ratings 200000 --concurrency 20 --steps 200
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import callbacks
+from cluster import ChatLanes
+
+# share of steps that record and publish a new voice message, like and skip a note
+RECORD_SHARE = 0.05
+LIKE_SHARE = 0.3
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+def seed(server, users, ratings, published_share, chunk_size=10000):
+    db = server.db_roaming
+    def insert(table, rows):
+        for i in range(0, len(rows), chunk_size):
+            with db as tx:
+                tx.executable.execute(tx[table].table.insert(), rows[i:i+chunk_size])
+
+    chat_ids = list(range(1_000_000, 1_000_000 + users))
+    insert('user', [server.user_model(chat_id=chat_id) for chat_id in chat_ids])
+    messages = [
+        server.message_model(
+            message_id=uuid.uuid4().hex, chat_id=chat_id, data=f'seed{chat_id}', published=True,
+            origin=f'<a href="tg://user?id={chat_id}">{chat_id}</a>',
+        )
+        for chat_id in chat_ids if random.random() < published_share
+    ]
+    insert('message', messages)
+    rows = []
+    for _ in range(ratings if messages else 0):
+        message = random.choice(messages)
+        from_id = random.choice(chat_ids)
+        if from_id == message['chat_id']: continue
+        rows.append(server.rating_model(
+            from_id=from_id, to_id=message['chat_id'], message_id=message['message_id'],
+            rating=1 if random.random() < LIKE_SHARE else -1,
+        ))
+    insert('rating', rows)
+    server.schema.backfill_likes(db)
+    return chat_ids
+
+class Recorder:
+    """Times handler calls and lets virtual users wait for their update to be handled."""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.durations = dict()  # handler -> list of seconds
+        self.handled = dict()    # chat_id -> number of handled updates
+
+    def wrap(self, callback):
+        def wrapper(update, context, *args):
+            started = time.perf_counter()
+            try:
+                return callback(update, context, *args)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.durations.setdefault(callback.__name__, []).append(elapsed)
+                    chat_id = update.effective_chat.id
+                    self.handled[chat_id] = self.handled.get(chat_id, 0) + 1
+                    self.lock.notify_all()
+        return wrapper
+
+    def wait(self, chat_id, count, timeout=30):
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.handled.get(chat_id, 0) >= count, timeout):
+                raise TimeoutError(f"update {count} of chat {chat_id} not handled within {timeout}s")
+
+def buttons(params):
+    markup = params.get('reply_markup')
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    if not markup: return dict()
+    return {button['text']: button['callback_data'] for row in markup['inline_keyboard'] for button in row}
+
+def virtual_user(fake, recorder, chat_id, steps, errors):
+    handled = 0
+    def push(update):
+        """Send the update and return the buttons of the bot's answers to it."""
+        nonlocal handled
+        answered = len(fake.sent(chat_id=chat_id))
+        update(chat_id)
+        handled += 1
+        recorder.wait(chat_id, handled)
+        found = dict()
+        for method, params in fake.sent(chat_id=chat_id)[answered:]:
+            found.update(buttons(params))
+        return found
+    try:
+        screen = push(lambda chat_id: fake.text_update(chat_id, '/start'))
+        for _ in range(steps):
+            roll = random.random()
+            if roll < RECORD_SHARE:
+                screen = push(lambda chat_id: fake.voice_update(chat_id, duration=60))
+                publish = screen.get('Publish') or screen.get('Replace my message')
+                if publish:
+                    screen = push(lambda chat_id: fake.callback_update(chat_id, publish))
+            elif 'Like' in screen and roll < RECORD_SHARE + LIKE_SHARE:
+                screen = push(lambda chat_id: fake.callback_update(chat_id, screen['Like']))
+            elif 'Next' in screen:
+                screen = push(lambda chat_id: fake.callback_update(chat_id, screen['Next']))
+            else:
+                # no note on screen, ask for one like the Start and Check Again buttons do
+                data = screen.get('Start') or screen.get('Check Again') or screen.get('Check for more messages')
+                screen = push(lambda chat_id: fake.callback_update(chat_id, data or callbacks.encode(callbacks.MORE)))
+    except Exception as e:
+        errors.append(e)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000, help='seeded users')
+    parser.add_argument('--ratings', type=int, default=10000, help='seeded ratings')
+    parser.add_argument('--published-share', type=float, default=0.8, help='share of seeded users with a published message')
+    parser.add_argument('--concurrency', type=int, default=10, help='virtual users active at the same time')
+    parser.add_argument('--steps', type=int, default=50, help='interactions per virtual user')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each fake Bot API call takes')
+    parser.add_argument('--throttle', action='store_true', help="keep the outbox's flood limits")
+    parser.add_argument('--workdir', help='directory for the benchmark roaming.db, a temporary one by default')
+    args = parser.parse_args()
+
+    # the bot opens roaming.db in the working directory, never touch the real one
+    workdir = args.workdir or tempfile.mkdtemp(prefix='unisono-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    if os.path.exists(os.path.join(workdir, 'roaming.db')):
+        sys.exit(f"{workdir} already contains a roaming.db")
+    os.chdir(workdir)
+
+    from bot_config import get_bot_config
+    import storage
+    if get_bot_config().get('database_url', storage.DEFAULT_URL) != storage.DEFAULT_URL:
+        sys.exit("database_url is set in bot_config, the benchmark only runs on a fresh roaming.db")
+
+    from fake_telegram import FakeTelegram
+    import server
+    from ratelimit import TokenBucket
+
+    fake = FakeTelegram(latency=args.latency).start()
+    server.bot_config['bot_api_url'] = fake.base_url
+    server.bot_config['bot_api_file_url'] = fake.base_file_url
+    if not args.throttle:
+        server.outbox.bucket = TokenBucket(1e9)
+        server.outbox.chat_rate = server.outbox.chat_burst = 1e9
+    server.schema.migrate(server.db_roaming)
+
+    started = time.perf_counter()
+    seed(server, args.users, args.ratings, args.published_share)
+    print(f"seeded {args.users} users and {args.ratings} ratings in {time.perf_counter() - started:.1f}s ({workdir})")
+
+    recorder = Recorder()
+    updater = server.create_updater()
+    for handlers in updater.dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler.callback, callbacks.CallbackRouter):
+                # time the buttons one by one
+                for action, (callback, payload) in handler.callback.routes.items():
+                    handler.callback.routes[action] = (recorder.wrap(callback), payload)
+            else:
+                handler.callback = recorder.wrap(handler.callback)
+    # fed the way main() does, in order per chat
+    lanes = ChatLanes(updater.dispatcher.process_update, server.bot_config.get('workers', 8))
+    intake = server.create_intake(lanes)
+    lanes.start()
+    intake.start_polling(poll_interval=0, timeout=1)
+
+    errors = []
+    chat_ids = range(2_000_000, 2_000_000 + args.concurrency)
+    threads = [
+        threading.Thread(target=virtual_user, args=(fake, recorder, chat_id, args.steps, errors))
+        for chat_id in chat_ids
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    intake.stop()
+    lanes.stop()
+    server.rating_writer.flush()
+
+    total = sum(len(durations) for durations in recorder.durations.values())
+    print(f"{total} updates in {elapsed:.1f}s: {total / elapsed:.1f} updates/s, {len(fake.calls)} Bot API calls")
+    print(f"{'handler':<24}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, durations in sorted(recorder.durations.items(), key=lambda item: -len(item[1])):
+        print(
+            f"{name:<24}{len(durations):>8}{sum(durations) / len(durations) * 1000:>10.1f}"
+            f"{percentile(durations, 0.5) * 1000:>10.1f}{percentile(durations, 0.99) * 1000:>10.1f}"
+            f"{max(durations) * 1000:>10.1f}"
+        )
+    if errors:
+        print(f"{len(errors)} virtual user(s) failed, first error: {errors[0]!r}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
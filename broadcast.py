@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+RUNNING = 'running'
+DONE = 'done'
+
+# pending recipients loaded and sent per round
+CHUNK_SIZE = 200
+# attempts per recipient for timeouts and network errors
+MAX_ATTEMPTS = 3
+
+# users who never recorded a message
+inactive_users_query = """
+INSERT INTO broadcast_recipient (broadcast_id, chat_id, status)
+SELECT :broadcast_id, u.chat_id, :status
+FROM "user" AS u LEFT JOIN message AS m ON m.chat_id = u.chat_id
+WHERE m.id IS NULL
+GROUP BY u.chat_id;
+"""
+
+progress_query = """
+SELECT status, count(*) AS count
+FROM broadcast_recipient
+WHERE broadcast_id = :broadcast_id
+GROUP BY status;
+"""
+
+class Broadcaster:
+    """Sends a message to many users in the background without tripping Telegram's flood limits.
+
+    A broadcast and the delivery state of each recipient are stored in the database, so a
+    broadcast interrupted by a restart continues with the recipients still pending.
+    """
+
+    def __init__(self, db, rate=25, workers=4):
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.running = dict()  # broadcast id -> thread
+
+    def create_inactive_users_broadcast(self, name, text, reply_markup=None, parse_mode=None):
+        """Store a broadcast to every user without a message and return its id."""
+        with self.db as tx:
+            broadcast_id = tx['broadcast'].insert(dict(
+                name=name,
+                text=text,
+                reply_markup=reply_markup.to_json() if reply_markup else None,
+                parse_mode=parse_mode,
+                status=RUNNING,
+                utc_timestamp=time.time(),
+            ))
+            tx.query(inactive_users_query, broadcast_id=broadcast_id, status=PENDING)
+        return broadcast_id
+
+    def progress(self, broadcast_id):
+        counts = {PENDING: 0, SENT: 0, FAILED: 0}
+        for row in self.db.query(progress_query, broadcast_id=broadcast_id):
+            counts[row['status']] = row['count']
+        return counts
+
+    def start(self, bot, broadcast_id, report_chat_id):
+        """Run the broadcast on a background thread unless it is already running."""
+        with self.lock:
+            thread = self.running.get(broadcast_id)
+            if thread and thread.is_alive(): return thread
+            thread = threading.Thread(
+                target=self._run, args=(bot, broadcast_id, report_chat_id),
+                name=f'broadcast-{broadcast_id}', daemon=True,
+            )
+            self.running[broadcast_id] = thread
+        thread.start()
+        return thread
+
+    def resume(self, bot, report_chat_id):
+        """Continue broadcasts that were interrupted, e.g. by a restart."""
+        for broadcast in self.db['broadcast'].find(status=RUNNING):
+            logger.info(f"resuming broadcast {broadcast['id']} ({broadcast['name']})")
+            self.start(bot, broadcast['id'], report_chat_id)
+
+    def _run(self, bot, broadcast_id, report_chat_id):
+        broadcast = self.db['broadcast'].find_one(id=broadcast_id)
+        reply_markup = InlineKeyboardMarkup.de_json(json.loads(broadcast['reply_markup']), bot) if broadcast['reply_markup'] else None
+        started = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'broadcast-{broadcast_id}') as pool:
+                last_id = 0
+                while True:
+                    recipients = list(self.db['broadcast_recipient'].find(
+                        broadcast_id=broadcast_id, status=PENDING, id={'>': last_id}, order_by='id', _limit=CHUNK_SIZE
+                    ))
+                    if not recipients: break
+                    last_id = recipients[-1]['id']
+                    # map() is lazy, wait for every send before the transaction takes the write lock
+                    results = list(pool.map(lambda recipient: self._send(bot, broadcast, reply_markup, recipient['chat_id']), recipients))
+                    # workers only talk to the Bot API, the outcome of a chunk is stored in one transaction
+                    with self.db as tx:
+                        for recipient, (status, error) in zip(recipients, results):
+                            tx['broadcast_recipient'].update(dict(id=recipient['id'], status=status, error=error), ['id'])
+                    self._report(bot, broadcast, report_chat_id, started)
+            self.db['broadcast'].update(dict(id=broadcast_id, status=DONE), ['id'])
+            self._report(bot, broadcast, report_chat_id, started, done=True)
+        except Exception:
+            logger.exception(f"broadcast {broadcast_id} stopped")
+
+    def _send(self, bot, broadcast, reply_markup, chat_id):
+        error = None
+        attempt = 0
+        while attempt < MAX_ATTEMPTS:
+            self.bucket.acquire()
+            try:
+                bot.send_message(chat_id, broadcast['text'], reply_markup=reply_markup, parse_mode=broadcast['parse_mode'])
+                return SENT, None
+            except RetryAfter as e:
+                # flood limit hit, hold back every worker and try again without using up an attempt
+                logger.warning(f"broadcast {broadcast['id']} rate limited for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+                continue
+            except (Unauthorized, BadRequest) as e:
+                # blocked the bot or chat gone, retrying won't help
+                return FAILED, str(e)
+            except NetworkError as e:
+                error = e
+                time.sleep(2 ** attempt)
+            except TelegramError as e:
+                return FAILED, str(e)
+            attempt += 1
+        return FAILED, str(error)
+
+    def _report(self, bot, broadcast, report_chat_id, started, done=False):
+        counts = self.progress(broadcast['id'])
+        elapsed = time.monotonic() - started
+        text = (
+            f"{'Done.' if done else 'Broadcasting...'}\n"
+            f"Message sent to {counts[SENT]} user(s).\n"
+            f"Failed: {counts[FAILED]}, pending: {counts[PENDING]}\n"
+            f"Elapsed: {elapsed:.0f}s"
+        )
+        try:
+            bot.send_message(report_chat_id, text)
+        except TelegramError:
+            logger.exception(f"reporting progress of broadcast {broadcast['id']} failed")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""callback_data of the inline keyboards and the router that handles their button presses.
+
+callback_data is VERSION, one action character and the payload, if any, as a base 36
+integer, e.g. '1Y2n9c' likes the message with row id 2n9c. Buttons sent before the
+protocol had a version carry the action as a prefix and the message_id in hex, e.g.
+'Y<32 hex digits>'; those are still understood so older chats keep working.
+"""
+
+import logging
+import string
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+VERSION = '1'
+
+# actions
+NEXT = 'N'        # skip the note, note
+LIKE = 'Y'        # like the note, note
+MORE = 'M'        # show a note
+HELP = 'F'        # tips for the first voice message
+PROMPT = 'P'      # a random prompt, count of prompts shown so far
+SAVE = 'S'        # publish a recorded message, recording
+DISCARD = 'D'     # drop a recorded message, recording
+REACT = 'R'       # send a recorded message as reaction, recording
+REACT_LIKE = 'L'  # record a reaction to a liked note, note
+
+# payload types
+NOTE = 'note'            # a published message, or a reaction sent to the presser
+RECORDING = 'recording'  # an unpublished message of the presser
+COUNT = 'count'
+
+# prefix before versioning -> action, longest first
+legacy_prefixes = [('LRY', REACT_LIKE), ('SM', SAVE), ('DM', DISCARD), ('RM', REACT)] + [
+    (action, action) for action in [NEXT, LIKE, MORE, HELP, PROMPT]
+]
+
+digits = string.digits + string.ascii_lowercase
+
+def encode(action, payload=None):
+    """callback_data for the action, payload is a message row id or count."""
+    if payload is None: return VERSION + action
+    if payload < 0:
+        raise ValueError("negative callback payload")
+    encoded = ''
+    while True:
+        payload, digit = divmod(payload, 36)
+        encoded = digits[digit] + encoded
+        if not payload: break
+    return VERSION + action + encoded
+
+def decode(data):
+    """(action, payload, legacy) of callback_data, the payload still unparsed."""
+    if data.startswith(VERSION):
+        return data[1:2], data[2:], False
+    for prefix, action in legacy_prefixes:
+        if data.startswith(prefix):
+            return action, data[len(prefix):], True
+    return None, None, False
+
+class CallbackRouter:
+    """The one CallbackQueryHandler callback, dispatching button presses by action.
+
+    The callback_data is decoded once and its payload checked before the route runs.
+    Routes with a NOTE or RECORDING payload are called with the message row, routes with
+    a COUNT with the integer, others with just update and context. The query is answered
+    here, so the routes don't have to.
+
+    Row ids are easy to guess and clients can send any callback_data, so a message is
+    only passed on if the presser may use it with that action; other presses, e.g. of a
+    Publish button tapped twice, are logged and dropped.
+    """
+
+    # routes are timed on their own, see metrics.instrument_dispatcher
+    timed = True
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.routes = dict()  # action -> (callback, payload type)
+
+    def add(self, action, callback, payload=None):
+        self.routes[action] = (metrics.timed_handler(callback), payload)
+
+    def _message(self, payload, legacy):
+        try:
+            if legacy:
+                message = self.repository.get_message(payload)
+            else:
+                message = self.repository.get_message_by_id(int(payload, 36))
+        except ValueError:
+            message = None
+        if not message:
+            raise(Exception("invalid message in callback data"))
+        return message
+
+    def _allowed(self, payload_type, message, chat_id):
+        if payload_type == RECORDING:
+            return message['chat_id'] == chat_id and not message['published']
+        if message['published']: return True
+        # a reaction's topic is the message_id of the note it answers
+        if message['topic'] == 'general': return False
+        answered = self.repository.get_message(message['topic'])
+        return answered is not None and answered['chat_id'] == chat_id
+
+    def _count(self, payload, legacy):
+        if not payload: return 0
+        try:
+            return max(int(payload, 10 if legacy else 36), 0)
+        except ValueError:
+            raise(Exception("malformed count in callback data"))
+
+    def __call__(self, update, context):
+        query = update.callback_query
+        query.answer()
+        action, payload, legacy = decode(query.data or '')
+        route = self.routes.get(action)
+        if not route:
+            raise(Exception(f"unknown callback data {query.data!r}"))
+        callback, payload_type = route
+        if payload_type in (NOTE, RECORDING):
+            message = self._message(payload, legacy)
+            if not self._allowed(payload_type, message, update.effective_chat.id):
+                logger.warning(f"chat {update.effective_chat.id} may not use message {message['id']} with {action}")
+                return None
+            return callback(update, context, message)
+        if payload_type == COUNT:
+            return callback(update, context, self._count(payload, legacy))
+        return callback(update, context)
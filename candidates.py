@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+import numpy as np
+
+from compaction import compacted_message_rows
+
+# a note's like ratio counts this many likes and dislikes on top of its own, new notes start at 1/2
+PRIOR = 1
+# the recency part of a note's weight halves every HALF_LIFE seconds, down to a half of the weight
+HALF_LIFE = 7 * 24 * 3600
+# notes by someone who liked one of the viewer's notes are this much more likely
+RECIPROCITY_BOOST = 3
+
+# per candidate, by position in message_ids
+FEATURES = dict(likes=np.int32, dislikes=np.int32, timestamp=np.float64, author=np.int64)
+
+latest_messages_query = """
+SELECT m.id, m.chat_id, m.topic, m.message_id, m.data, m.utc_timestamp
+FROM (
+    select chat_id, topic, max(utc_timestamp) as max_utc_timestamp
+    from message
+    where published = :published
+    group by chat_id, topic
+) as x inner join message as m on m.chat_id = x.chat_id and m.topic = x.topic and m.utc_timestamp = x.max_utc_timestamp;
+"""
+
+rating_counts_query = """
+SELECT message_id, sum(CASE WHEN rating = 1 THEN 1 ELSE 0 END) AS likes, sum(CASE WHEN rating = -1 THEN 1 ELSE 0 END) AS dislikes
+FROM (
+    select message_id, rating from rating
+    union all
+    select message_id, rating from rating_archive
+) as r
+GROUP BY message_id;
+"""
+
+class CandidateIndex:
+    """Latest published message per (chat_id, topic) and the message ids each user has rated.
+
+    The index is built from the database on first use and afterwards kept up to date
+    by the handlers that publish messages or record ratings, so picking a note does not
+    have to scan the message and rating tables.
+
+    Next to the message ids, NumPy arrays hold the features notes are ranked by: their
+    likes and dislikes, when they were published and by whom. sample_unseen() weighs all
+    candidates in one pass over the arrays: by like ratio, by recency, and up when the
+    author liked one of the viewer's notes. Every candidate keeps some weight, so new and
+    unpopular notes are still heard. With several worker processes each counts the
+    ratings it handles on top of those loaded at start.
+
+    The lock only guards the in-memory state: queries run without it and their results
+    are added under it, and the weights are computed from views of the arrays after
+    releasing it, so one user's first swipe doesn't hold up everyone else's.
+    """
+
+    def __init__(self, db, half_life=HALF_LIFE, reciprocity_boost=RECIPROCITY_BOOST):
+        self.db = db
+        self.half_life = half_life
+        self.reciprocity_boost = reciprocity_boost
+        self.random = np.random.default_rng()
+        self.lock = threading.RLock()
+        self.load_lock = threading.Lock()  # one thread builds the index, the others wait for it
+        self.generation = 0                # bumped by reset(), results of older queries are dropped
+        self.loaded = False
+        self.early = []                    # messages published while the index was being loaded
+        self.moves = 0                     # bumped whenever candidates change positions
+        self.latest = dict()     # (chat_id, topic) -> message
+        self.messages = dict()   # message_id -> message
+        self.message_ids = []    # message ids to sample from
+        self.positions = dict()  # message_id -> position in message_ids
+        self.row_ids = dict()    # message row id -> message_id
+        self.seen = dict()       # chat_id -> set of rated message ids
+        self.liked_by = dict()   # chat_id -> set of chat_ids that liked one of its notes
+        self.features = {name: np.zeros(0, dtype) for name, dtype in FEATURES.items()}
+
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.moves += 1
+            self.loaded = False
+            self.early.clear()
+            self.latest.clear()
+            self.messages.clear()
+            self.message_ids.clear()
+            self.positions.clear()
+            self.row_ids.clear()
+            self.seen.clear()
+            self.liked_by.clear()
+            self.features = {name: np.zeros(0, dtype) for name, dtype in FEATURES.items()}
+
+    def _load(self):
+        if self.loaded: return
+        with self.load_lock:
+            if self.loaded: return
+            generation = self.generation
+            messages = [dict(msg) for msg in self.db.query(latest_messages_query, published=True)]
+            counts = list(self.db.query(rating_counts_query))
+            with self.lock:
+                if generation != self.generation: return
+                for message in messages + self.early:
+                    self._publish(message)
+                self.early.clear()
+                for row in counts:
+                    position = self.positions.get(row['message_id'])
+                    if position is not None:
+                        self.features['likes'][position] = row['likes']
+                        self.features['dislikes'][position] = row['dislikes']
+                self.loaded = True
+
+    def _add(self, message):
+        position = len(self.message_ids)
+        if position == len(self.features['author']):
+            # double the arrays, so adding stays O(1) on average
+            capacity = max(2 * position, 1024)
+            for name, array in self.features.items():
+                self.features[name] = np.zeros(capacity, array.dtype)
+                self.features[name][:position] = array[:position]
+        self.features['likes'][position] = 0
+        self.features['dislikes'][position] = 0
+        self.features['timestamp'][position] = message['utc_timestamp']
+        self.features['author'][position] = message['chat_id']
+        self.messages[message['message_id']] = message
+        self.positions[message['message_id']] = position
+        self.message_ids.append(message['message_id'])
+        self.row_ids[message['id']] = message['message_id']
+
+    def _remove(self, message_id):
+        # swap with the last element so removal stays O(1)
+        position = self.positions.pop(message_id)
+        last_id = self.message_ids.pop()
+        self.moves += 1
+        if last_id != message_id:
+            self.message_ids[position] = last_id
+            self.positions[last_id] = position
+            for array in self.features.values():
+                array[position] = array[len(self.message_ids)]
+        del self.row_ids[self.messages.pop(message_id)['id']]
+
+    def _publish(self, message):
+        key = (message['chat_id'], message['topic'])
+        current = self.latest.get(key)
+        if current:
+            if current['utc_timestamp'] > message['utc_timestamp']: return
+            self._remove(current['message_id'])
+        self.latest[key] = message
+        self._add(message)
+
+    def publish(self, message):
+        """Register a message that has just been published."""
+        if not message or not message['published']: return
+        message = dict(
+            id=message['id'],
+            chat_id=message['chat_id'],
+            topic=message['topic'],
+            message_id=message['message_id'],
+            data=message['data'],
+            utc_timestamp=message['utc_timestamp'],
+        )
+        with self.lock:
+            if not self.loaded:
+                # the initial load may have read the messages before this one was published
+                if self.load_lock.locked():
+                    self.early.append(message)
+                return
+            self._publish(message)
+
+    def _seen(self, chat_id):
+        """The set of message ids chat_id rated, call without holding the lock."""
+        seen = self.seen.get(chat_id)
+        if seen is not None: return seen
+        self._load()
+        generation = self.generation
+        # ratings before the compacted ones, a rating compacted in between is then found twice, not never
+        rated = set([rating['message_id'] for rating in self.db['rating'].find(from_id=chat_id)])
+        compacted = compacted_message_rows(self.db, chat_id)
+        with self.lock:
+            # only candidates need to be known as seen, their row ids are all in the index
+            rated.update(self.row_ids[row_id] for row_id in compacted if row_id in self.row_ids)
+            if generation != self.generation: return rated
+            # another thread may have loaded them meanwhile, and added ratings to its set since
+            return self.seen.setdefault(chat_id, rated)
+
+    def _liked_by(self, chat_id):
+        """The set of chat_ids that liked a note of chat_id, call without holding the lock."""
+        liked_by = self.liked_by.get(chat_id)
+        if liked_by is not None: return liked_by
+        generation = self.generation
+        liked_by = set([like['from_id'] for like in self.db['user_like'].find(to_id=chat_id)])
+        with self.lock:
+            if generation != self.generation: return liked_by
+            return self.liked_by.setdefault(chat_id, liked_by)
+
+    def add_rating(self, rating):
+        """Mark the rated message as seen by the rater and count the rating in its features."""
+        # load the ratings already stored first, this one may not be written yet
+        seen = self._seen(rating['from_id'])
+        with self.lock:
+            seen.add(rating['message_id'])
+            position = self.positions.get(rating['message_id'])
+            if position is not None:
+                self.features['likes' if rating['rating'] == 1 else 'dislikes'][position] += 1
+            # not loaded yet, the like is read from user_like with the others
+            if rating['rating'] == 1 and rating['to_id'] in self.liked_by:
+                self.liked_by[rating['to_id']].add(rating['from_id'])
+
+    def get_message(self, message_id):
+        self._load()
+        with self.lock:
+            return self.messages.get(message_id)
+
+    def available(self, chat_id, message_id):
+        """The message if it is still a candidate chat_id has neither written nor rated, else None."""
+        seen = self._seen(chat_id)
+        with self.lock:
+            message = self.messages.get(message_id)
+            if not message or message['chat_id'] == chat_id: return None
+            if message_id in seen: return None
+            return message
+
+    def _weights(self, chat_id, features, seen_positions, liked_by):
+        """Weight of every candidate for chat_id, 0 for its own and rated notes."""
+        likes, dislikes, timestamp, author = (features[name] for name in FEATURES)
+        weights = (likes + PRIOR) / (likes + dislikes + 2 * PRIOR)
+        age = np.maximum(time.time() - timestamp, 0)
+        weights *= 0.5 + 0.5 * np.exp2(-age / self.half_life)
+        if liked_by:
+            weights[np.isin(author, np.fromiter(liked_by, np.int64, len(liked_by)))] *= self.reciprocity_boost
+        weights[author == chat_id] = 0
+        weights[seen_positions] = 0
+        return weights
+
+    def sample_unseen(self, chat_id, count):
+        """Up to count messages chat_id has neither written nor rated, drawn by weight without replacement."""
+        seen = self._seen(chat_id)
+        liked_by = self._liked_by(chat_id)
+        while True:
+            with self.lock:
+                moves = self.moves
+                # views, a rating counted meanwhile only shifts a weight a little
+                features = {name: array[:len(self.message_ids)] for name, array in self.features.items()}
+                seen_positions = np.fromiter((self.positions[m] for m in seen if m in self.positions), np.int64)
+                liked_by = list(liked_by)
+            weights = self._weights(chat_id, features, seen_positions, liked_by)
+            candidates = np.flatnonzero(weights)
+            # weighted sampling by keys u ** (1 / weight), compared as logarithms
+            keys = np.log(self.random.random(len(candidates))) / weights[candidates]
+            if count < len(candidates):
+                top = np.argpartition(-keys, count)[:count]
+                candidates, keys = candidates[top], keys[top]
+            with self.lock:
+                # a note was replaced while weighing and the positions moved, weigh again
+                if moves != self.moves: continue
+                return [self.messages[self.message_ids[position]] for position in candidates[np.argsort(-keys)]]
+
+    def random_unseen(self, chat_id):
+        """Pick a message chat_id has neither written nor rated by weight, or None."""
+        messages = self.sample_unseen(chat_id, 1)
+        return messages[0] if messages else None
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import logging
+import multiprocessing
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+def chat_key(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+def partition(update, count):
+    """Worker number for an update, the same for all updates of a chat."""
+    return chat_key(update) % count
+
+class ChatLanes:
+    """`count` threads, each handling the updates of its chats in order.
+
+    The updates of a chat always go to the same lane and are handled one after the
+    other, while different chats are handled concurrently. A worker process receives the
+    chats with chat_key % workers == its number, there `stride` is the number of workers
+    so that the lanes split those chats evenly.
+    """
+
+    def __init__(self, handle, count, stride=1):
+        self.handle = handle
+        self.stride = stride
+        self.queues = [queue.Queue() for _ in range(count)]
+        self.threads = [
+            threading.Thread(target=self._run, args=(lane,), name=f'lane-{number}', daemon=True)
+            for number, lane in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, update):
+        self.queues[chat_key(update) // self.stride % len(self.queues)].put(update)
+
+    def forward(self, update, context):
+        """Handler callback of the intake dispatcher."""
+        self.put(update)
+
+    def _run(self, lane):
+        while True:
+            update = lane.get()
+            if update is None: break
+            try:
+                self.handle(update)
+            except Exception:
+                logger.exception("handling an update failed")
+
+    def stop(self):
+        """Handle the updates queued so far and end the threads."""
+        for lane in self.queues:
+            lane.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class Intake:
+    """Routes updates to `count` worker processes by chat_id.
+
+    Each worker receives ('update', dict) items on its own queue, in the order the updates
+    arrived, and the updates of a chat always go to the same worker, where ChatLanes
+    handles them one after the other. Workers put
+    (number, kind, payload) events on the shared events queue, which are passed on as
+    (kind, payload) to all other workers.
+
+    Workers are started with the spawn method, so they import the bot afresh and don't
+    inherit the threads and connections of this process.
+    """
+
+    def __init__(self, target, count):
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(count)]
+        self.events = context.Queue()
+        self.processes = [
+            context.Process(target=target, args=(number, count, self.queues[number], self.events), name=f'worker-{number}')
+            for number in range(count)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self._relay_events, name='cluster_events', daemon=True).start()
+        logger.info(f"started {len(self.processes)} worker processes")
+
+    def forward(self, update, context):
+        """Handler callback of the intake dispatcher."""
+        self.queues[partition(update, len(self.queues))].put(('update', update.to_dict()))
+
+    def _relay_events(self):
+        while True:
+            origin, kind, payload = self.events.get()
+            for number, queue in enumerate(self.queues):
+                if number != origin:
+                    queue.put((kind, payload))
+
+    def stop(self):
+        """Let the workers handle the updates they received and wait for them to exit."""
+        for queue in self.queues:
+            queue.put(('stop', None))
+        for process in self.processes:
+            process.join()
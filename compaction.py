@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# ratings moved to the archive per transaction
+CHUNK_SIZE = 5000
+
+old_dislikes_query = text("""
+SELECT r.id, r.from_id, r.to_id, r.message_id, r.rating, r.utc_timestamp, m.id AS message_row
+FROM rating AS r LEFT JOIN message AS m ON m.message_id = r.message_id
+WHERE r.rating = :rating AND r.utc_timestamp < :cutoff
+ORDER BY r.id
+LIMIT :limit;
+""")
+archive_query = text("""
+INSERT INTO rating_archive (from_id, to_id, message_id, rating, utc_timestamp)
+VALUES (:from_id, :to_id, :message_id, :rating, :utc_timestamp);
+""")
+delete_query = text("DELETE FROM rating WHERE id = :id;")
+seen_query = text("SELECT message_rows FROM user_seen WHERE chat_id = :chat_id;")
+insert_seen_query = text("""
+INSERT INTO user_seen (chat_id, message_rows, message_count, utc_timestamp)
+VALUES (:chat_id, :message_rows, :message_count, :utc_timestamp);
+""")
+update_seen_query = text("""
+UPDATE user_seen SET message_rows = :message_rows, message_count = :message_count, utc_timestamp = :utc_timestamp
+WHERE chat_id = :chat_id;
+""")
+
+def encode_ids(ids):
+    """Pack positive integers as varint deltas of their sorted values, 1-2 bytes per id when dense."""
+    data = bytearray()
+    previous = 0
+    for value in sorted(set(ids)):
+        delta = value - previous
+        previous = value
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+def decode_ids(data):
+    ids = []
+    value = shift = previous = 0
+    for byte in data or b'':
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += value
+        ids.append(previous)
+        value = shift = 0
+    return ids
+
+def compacted_message_rows(db, chat_id):
+    """Row ids of the messages chat_id disliked and whose ratings were compacted."""
+    for row in db.query(seen_query, chat_id=chat_id):
+        return set(decode_ids(row['message_rows']))
+    return set()
+
+class RatingCompactor:
+    """Moves dislikes older than `ttl` seconds out of the rating table.
+
+    Only the fact that a user has seen a message matters for those, so they are folded
+    into one compact row per user in user_seen, and the raw rows go to rating_archive.
+    The rating table then holds the likes and the recent dislikes only, whatever the
+    age of the bot. Likes stay, they are needed for matches and the examples.
+    """
+
+    def __init__(self, db, ttl=30*24*3600, interval=3600, chunk_size=CHUNK_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='rating_compactor', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("compacting ratings failed")
+            time.sleep(self.interval)
+
+    def compact(self):
+        """Compact all dislikes older than the ttl, return their number."""
+        cutoff = time.time() - self.ttl
+        total = 0
+        while True:
+            moved = self._compact_chunk(cutoff)
+            if not moved: break
+            total += moved
+        if total:
+            logger.info(f"compacted {total} ratings")
+        return total
+
+    def _compact_chunk(self, cutoff):
+        with self.db as tx:
+            connection = tx.executable
+            rows = [dict(row) for row in connection.execute(old_dislikes_query, rating=-1, cutoff=cutoff, limit=self.chunk_size).mappings()]
+            if not rows: return 0
+            connection.execute(archive_query, rows)
+            message_rows = dict()  # from_id -> row ids of the disliked messages
+            for row in rows:
+                # the message may have been deleted, then there is nothing left to hide
+                if row['message_row'] is not None:
+                    message_rows.setdefault(row['from_id'], set()).add(row['message_row'])
+            now = time.time()
+            for chat_id, ids in message_rows.items():
+                existing = connection.execute(seen_query, chat_id=chat_id).first()
+                if existing:
+                    ids |= set(decode_ids(existing[0]))
+                params = dict(chat_id=chat_id, message_rows=encode_ids(ids), message_count=len(ids), utc_timestamp=now)
+                connection.execute(update_seen_query if existing else insert_seen_query, params)
+            connection.execute(delete_query, [dict(id=row['id']) for row in rows])
+        return len(rows)
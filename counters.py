@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import time
+
+from sqlalchemy import text
+
+from writer import BufferedWriter
+
+# width of the time buckets in seconds, bucket 0 holds the totals
+BUCKET = 3600
+
+update_query = text("UPDATE stat_counter SET value = value + :delta WHERE name = :name AND bucket = :bucket;")
+insert_query = text("INSERT INTO stat_counter (name, bucket, value) VALUES (:name, :bucket, :delta);")
+totals_query = text("SELECT name, value FROM stat_counter WHERE bucket = 0;")
+buckets_query = text("SELECT name, bucket, value FROM stat_counter WHERE bucket >= :since;")
+delete_query = text("DELETE FROM stat_counter WHERE name = :name;")
+
+def bucket_of(timestamp):
+    return int(timestamp // BUCKET * BUCKET)
+
+class Counters:
+    """Event counters, in total and per hour, kept in the stat_counter table.
+
+    The handlers count events with inc() as they write them, and the increments are added
+    to the table by a background thread every `flush_interval` seconds. Reading the totals
+    and recent hours only touches a few rows of stat_counter however big the other tables
+    are, and is shared by all processes of the bot.
+    """
+
+    def __init__(self, db, flush_interval=5):
+        self.db = db
+        self.flush_interval = flush_interval
+        # pending: (name, bucket) -> increment not written yet
+        self.writer = BufferedWriter('counters', self._write, self._requeue, delay=flush_interval)
+
+    def inc(self, name, amount=1):
+        now = time.time()
+        with self.writer.condition:
+            pending = self.writer.pending
+            for key in [(name, 0), (name, bucket_of(now))]:
+                pending[key] = pending.get(key, 0) + amount
+            self.writer.added()
+
+    def flush(self):
+        self.writer.flush()
+
+    def _write(self, pending):
+        with self.db as tx:
+            for (name, bucket), delta in pending.items():
+                params = dict(name=name, bucket=bucket, delta=delta)
+                if not tx.executable.execute(update_query, params).rowcount:
+                    tx.executable.execute(insert_query, params)
+
+    def _requeue(self, failed, pending):
+        # the transaction was rolled back, add them again with the next flush
+        for key, delta in failed.items():
+            pending[key] = pending.get(key, 0) + delta
+
+    def _with_pending(self, rows):
+        with self.writer.condition:
+            pending = dict(self.writer.pending)
+        for key, delta in pending.items():
+            rows[key] = rows.get(key, 0) + delta
+        return rows
+
+    def totals(self):
+        """name -> count of all time."""
+        rows = {(row['name'], 0): row['value'] for row in self.db.query(totals_query)}
+        return {name: value for (name, bucket), value in self._with_pending(rows).items() if bucket == 0}
+
+    def hourly(self, hours=24):
+        """name -> {bucket start: count} for the last hours, including the current one."""
+        since = bucket_of(time.time()) - (hours - 1) * BUCKET
+        rows = {(row['name'], row['bucket']): row['value'] for row in self.db.query(buckets_query, since=since)}
+        result = dict()
+        for (name, bucket), value in self._with_pending(rows).items():
+            if bucket >= since:
+                result.setdefault(name, dict())[bucket] = value
+        return result
+
+    def reset(self, names):
+        with self.writer.write_lock:
+            with self.writer.condition:
+                for key in [key for key in self.writer.pending if key[0] in names]:
+                    del self.writer.pending[key]
+            with self.db as tx:
+                for name in names:
+                    tx.executable.execute(delete_query, name=name)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import logging
+import random
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# notes kept in the pool
+POOL_SIZE = 100
+
+most_liked_query = text("""
+SELECT m.message_id, m.chat_id, m.data, count(DISTINCT r.from_id) AS likes
+FROM rating AS r INNER JOIN message AS m ON m.message_id = r.message_id
+WHERE r.rating = :rating AND m.published = :published
+GROUP BY m.message_id, m.chat_id, m.data
+ORDER BY likes DESC
+LIMIT :limit;
+""")
+insert_query = text("""
+INSERT INTO example (message_id, chat_id, data, likes, utc_timestamp)
+VALUES (:message_id, :chat_id, :data, :likes, :utc_timestamp);
+""")
+
+class ExamplePool:
+    """The most liked published notes, played to users who haven't recorded one yet.
+
+    The pool is recomputed from the ratings every `interval` seconds by a background
+    thread and stored in the example table, so a restart doesn't need to recompute it.
+    Sampling only looks at the pool and prefers notes with more likes.
+    """
+
+    def __init__(self, db, size=POOL_SIZE, interval=600):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.examples = None  # list of example rows, loaded on first use
+        self.thread = None
+
+    def start(self, compute=True):
+        """Keep the pool up to date, without compute only by reloading what another process stored."""
+        self.thread = threading.Thread(target=self._run, args=(compute,), name='example_pool', daemon=True)
+        self.thread.start()
+
+    def _run(self, compute):
+        while True:
+            try:
+                if compute:
+                    self.refresh()
+                else:
+                    self.reset()
+                    self._load()
+            except Exception:
+                logger.exception("refreshing the example pool failed")
+            time.sleep(self.interval)
+
+    def reset(self):
+        with self.lock:
+            self.examples = None
+
+    def refresh(self):
+        now = time.time()
+        with self.db as tx:
+            connection = tx.executable
+            examples = [
+                dict(row, utc_timestamp=now) for row in
+                connection.execute(most_liked_query, rating=1, published=True, limit=self.size).mappings()
+            ]
+            tx['example'].delete()
+            if examples:
+                connection.execute(insert_query, examples)
+        with self.lock:
+            self.examples = examples
+
+    def _load(self):
+        with self.lock:
+            if self.examples is not None: return self.examples
+        examples = [dict(row) for row in self.db['example'].all()]
+        if not examples:
+            # first start after the upgrade, or the pool wasn't computed yet
+            self.refresh()
+            return self.examples
+        with self.lock:
+            self.examples = examples
+        return examples
+
+    def sample(self, chat_id, k=2):
+        """Up to k distinct examples not recorded by chat_id, more liked ones more likely."""
+        examples = [example for example in self._load() if example['chat_id'] != chat_id]
+        chosen = []
+        while examples and len(chosen) < k:
+            example = random.choices(examples, weights=[example['likes'] for example in examples])[0]
+            examples.remove(example)
+            chosen.append(example)
+        return chosen
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Local stand-in for the Telegram Bot API.
+
+Point the bot at it with bot_config['bot_api_url'] (e.g. http://127.0.0.1:8081/bot) and
+bot_config['bot_api_file_url'] (http://127.0.0.1:8081/file/bot) to run it without talking to
+Telegram. Outgoing calls are recorded, and updates pushed with push_update() are posted to
+the webhook if one is set or served through getUpdates.
+
+    python fake_telegram.py --port 8081
+"""
+
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = dict(id=1000, is_bot=True, first_name='Unisono', username='unisono_bot')
+# content of every downloaded file
+FILE_CONTENT = b'OggS fake voice'
+
+class FakeError(Exception):
+    def __init__(self, status, description):
+        super().__init__(description)
+        self.status = status
+        self.description = description
+
+class Server(ThreadingHTTPServer):
+    # socketserver's default backlog of 5 drops connections of the bot's request pool,
+    # whose retries a second later would show up as handler latency
+    request_queue_size = 128
+    daemon_threads = True
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.latency = latency  # seconds each call takes, to imitate the round trip to Telegram
+        self.calls = []         # (method, params)
+        self.lock = threading.Lock()
+        self.updates = queue.Queue()
+        self.webhook_url = None
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.expired_file_ids = set()  # sendVoice and getFile reject these like Telegram does stale ids
+        self.httpd = Server((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    @property
+    def base_file_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/file/bot'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake_telegram', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.startswith('/file/'):
+                    self._respond(200, FILE_CONTENT, 'application/octet-stream')
+                    return
+                # /bot<token>/<method>
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                elif content_type.startswith('multipart/form-data'):
+                    params = fake._multipart(content_type, body)
+                else:
+                    params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+                try:
+                    status, payload = 200, dict(ok=True, result=fake.call(method, params))
+                except FakeError as e:
+                    status, payload = e.status, dict(ok=False, error_code=e.status, description=e.description)
+                self._respond(status, json.dumps(payload).encode(), 'application/json')
+
+            do_GET = do_POST
+
+            def _respond(self, status, payload, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+    def call(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls.append((method, params))
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(float(params.get('timeout') or 0))
+        if method == 'sendMessage':
+            return self._message(params['chat_id'], text=params.get('text'))
+        if method == 'sendVoice':
+            voice = params.get('voice')
+            if voice in self.expired_file_ids:
+                raise FakeError(400, 'Bad Request: wrong file identifier/HTTP URL specified')
+            if not isinstance(voice, str) or voice.startswith('<upload'):
+                voice = f'voice{next(self.file_ids)}'
+            return self._message(params['chat_id'], voice=dict(file_id=voice, file_unique_id=voice, duration=5))
+        if method == 'getFile':
+            file_id = params.get('file_id')
+            if file_id in self.expired_file_ids:
+                raise FakeError(400, 'Bad Request: wrong file_id or the file is temporarily unavailable')
+            return dict(file_id=file_id, file_unique_id=file_id, file_size=len(FILE_CONTENT), file_path=f'voice/{file_id}.oga')
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url') or None
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if method == 'getWebhookInfo':
+            return dict(url=self.webhook_url or '', has_custom_certificate=False, pending_update_count=self.updates.qsize())
+        return True
+
+    def _multipart(self, content_type, body):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+        )
+        params = dict()
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = f'<upload of {len(part.get_payload(decode=True))} bytes>'
+            else:
+                params[name] = part.get_content().strip()
+        return params
+
+    def _get_updates(self, timeout):
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait())
+            while True:
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+    def _message(self, chat_id, **content):
+        return dict(
+            message_id=next(self.message_ids),
+            date=int(time.time()),
+            chat=dict(id=int(chat_id), type='private'),
+            **{'from': BOT_USER},
+            **content,
+        )
+
+    def sent(self, method=None, chat_id=None):
+        """Recorded calls, optionally only those of a method or to a chat."""
+        with self.lock:
+            return [
+                (m, params) for m, params in self.calls
+                if (method is None or m == method) and (chat_id is None or str(params.get('chat_id')) == str(chat_id))
+            ]
+
+    def push_update(self, update):
+        update = dict(update, update_id=next(self.update_ids))
+        if self.webhook_url:
+            request = urllib.request.Request(
+                self.webhook_url, data=json.dumps(update).encode(), headers={'Content-Type': 'application/json'}
+            )
+            urllib.request.urlopen(request).read()
+        else:
+            self.updates.put(update)
+        return update
+
+    def _user(self, chat_id):
+        return dict(id=chat_id, is_bot=False, first_name='User', last_name=str(chat_id))
+
+    def text_update(self, chat_id, text):
+        entities = [dict(type='bot_command', offset=0, length=len(text.split(' ')[0]))] if text.startswith('/') else []
+        return self.push_update(dict(message=dict(
+            message_id=next(self.message_ids), date=int(time.time()),
+            chat=dict(id=chat_id, type='private'), **{'from': self._user(chat_id)},
+            text=text, entities=entities,
+        )))
+
+    def voice_update(self, chat_id, file_id=None, duration=5):
+        file_id = file_id or f'voice{next(self.file_ids)}'
+        return self.push_update(dict(message=dict(
+            message_id=next(self.message_ids), date=int(time.time()),
+            chat=dict(id=chat_id, type='private'), **{'from': self._user(chat_id)},
+            voice=dict(file_id=file_id, file_unique_id=file_id, duration=duration),
+        )))
+
+    def callback_update(self, chat_id, data):
+        return self.push_update(dict(callback_query=dict(
+            id=str(next(self.update_ids)), chat_instance=str(chat_id), data=data,
+            **{'from': self._user(chat_id)},
+            message=dict(message_id=next(self.message_ids), date=int(time.time()), chat=dict(id=chat_id, type='private')),
+        )))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='seconds each Bot API call takes')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG
+    )
+    fake = FakeTelegram(args.host, args.port, args.latency)
+    logger.info(f"fake Bot API listening on {fake.base_url}")
+    fake.httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# number of message ids prefetched per chat
+FEED_SIZE = 20
+# refill a feed in the background once it holds fewer message ids than this
+FEED_LOW_WATER = 5
+
+class Feed:
+    """Queue of unseen candidate message ids per chat_id, drawn by the index's ranking.
+
+    Swipes are served by popping from the queue; queues running low are refilled by a
+    background thread from the CandidateIndex. Entries are checked against the index
+    when popped, so a queue never serves a note that was rated or replaced meanwhile.
+    """
+
+    def __init__(self, index, size=FEED_SIZE, low_water=FEED_LOW_WATER):
+        self.index = index
+        self.size = size
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.queues = dict()            # chat_id -> list of message ids
+        self.generation = 0             # bumped whenever a note is published
+        self.queue_generation = dict()  # chat_id -> generation the queue was filled in
+        self.pending = set()            # chat_ids waiting for a refill
+        self.refills = queue.Queue()
+        self.worker = None
+
+    def reset(self):
+        with self.lock:
+            self.queues.clear()
+            self.queue_generation.clear()
+            self.generation += 1
+
+    def _request_refill(self, chat_id):
+        if chat_id in self.pending: return
+        self.pending.add(chat_id)
+        if not self.worker:
+            self.worker = threading.Thread(target=self._run, name='feed-refill', daemon=True)
+            self.worker.start()
+        self.refills.put(chat_id)
+
+    def _run(self):
+        while True:
+            chat_id = self.refills.get()
+            try:
+                self.refill(chat_id)
+            except Exception:
+                logger.exception(f"refilling feed of {chat_id} failed")
+            finally:
+                with self.lock:
+                    self.pending.discard(chat_id)
+
+    def refill(self, chat_id):
+        with self.lock:
+            generation = self.generation
+        # next() pops from the end, the first drawn goes last
+        candidates = [message['message_id'] for message in reversed(self.index.sample_unseen(chat_id, self.size))]
+        with self.lock:
+            self.queues[chat_id] = candidates
+            self.queue_generation[chat_id] = generation
+
+    def next(self, chat_id):
+        """Pop the next unseen message for chat_id, or None if there is none."""
+        with self.lock:
+            message = None
+            message_ids = self.queues.get(chat_id, [])
+            while message_ids and not message:
+                message = self.index.available(chat_id, message_ids.pop())
+            if len(message_ids) < self.low_water or self.queue_generation.get(chat_id) != self.generation:
+                self._request_refill(chat_id)
+        if message: return message
+        # nothing prefetched yet, pick directly while the queue is being filled
+        return self.index.random_unseen(chat_id)
+
+    def add_rating(self, rating):
+        self.index.add_rating(rating)
+        with self.lock:
+            message_ids = self.queues.get(rating['from_id'])
+            if message_ids and rating['message_id'] in message_ids:
+                message_ids.remove(rating['message_id'])
+
+    def publish(self, message):
+        self.index.publish(message)
+        with self.lock:
+            # queues are refilled lazily on their next swipe so the new note gets mixed in
+            self.generation += 1
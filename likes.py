@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import time
+
+from sqlalchemy import text
+
+# writes first, so on SQLite the transaction holds the write lock before reading the reverse like
+like_query = text("""
+INSERT INTO user_like (from_id, to_id, utc_timestamp)
+SELECT :from_id, :to_id, :utc_timestamp
+WHERE NOT EXISTS (SELECT 1 FROM user_like WHERE from_id = :from_id AND to_id = :to_id);
+""")
+
+match_query = text("""
+INSERT INTO user_match (user_a, user_b, utc_timestamp)
+SELECT :user_a, :user_b, :utc_timestamp
+WHERE EXISTS (SELECT 1 FROM user_like WHERE from_id = :to_id AND to_id = :from_id)
+AND NOT EXISTS (SELECT 1 FROM user_match WHERE user_a = :user_a AND user_b = :user_b);
+""")
+
+# PostgreSQL doesn't serialize writers, so likes between the same two users take turns
+pair_lock_query = text("SELECT pg_advisory_xact_lock(CAST(:user_a AS bigint) # CAST(:user_b AS bigint));")
+
+liked_messages_query = """
+SELECT DISTINCT m.message_id, m.data
+FROM rating AS r INNER JOIN message AS m ON m.message_id = r.message_id
+WHERE r.from_id = :from_id AND r.to_id = :to_id AND r.rating = 1;
+"""
+
+class LikesGraph:
+    """Who liked whom and which pairs matched, keyed by (from_id, to_id).
+
+    A like and the match it may complete are recorded in one transaction, and the unique
+    indexes on both tables make sure a pair is matched, and notified, only once.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def like(self, from_id, to_id):
+        """Record that from_id liked a message of to_id, return True if this completed a new match."""
+        params = dict(
+            from_id=from_id,
+            to_id=to_id,
+            user_a=min(from_id, to_id),
+            user_b=max(from_id, to_id),
+            utc_timestamp=time.time(),
+        )
+        with self.db as tx:
+            if self.db.is_postgres:
+                tx.executable.execute(pair_lock_query, params)
+            tx.executable.execute(like_query, params)
+            return tx.executable.execute(match_query, params).rowcount > 0
+
+    def liked_messages(self, from_id, to_id):
+        """The messages of to_id that from_id liked."""
+        return list(self.db.query(liked_messages_query, from_id=from_id, to_id=to_id))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import functools
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+from telegram.utils.request import Request
+
+import profiling
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+class Registry:
+    """Counters, latency histograms and gauges, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = dict()        # name -> help text
+        self.histograms = dict()  # name -> {labels: Histogram}
+        self.counters = dict()    # name -> {labels: value}
+        self.gauges = dict()      # name -> function returning the current value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            histograms = self.histograms.setdefault(name, dict())
+            key = tuple(sorted(labels.items()))
+            histogram = histograms.get(key)
+            if not histogram:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            counters = self.counters.setdefault(name, dict())
+            key = tuple(sorted(labels.items()))
+            counters[key] = counters.get(key, 0) + amount
+
+    def gauge(self, name, function, help=''):
+        with self.lock:
+            self.gauges[name] = function
+            self.help[name] = help
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def summary(self, name):
+        """(labels, count, mean, max) of every histogram called name."""
+        with self.lock:
+            return [
+                (dict(labels), histogram.count, histogram.sum / histogram.count, histogram.max)
+                for labels, histogram in self.histograms.get(name, dict()).items() if histogram.count
+            ]
+
+    def total(self, name):
+        with self.lock:
+            return sum(self.counters.get(name, dict()).values())
+
+    def render(self):
+        lines = []
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs: return ''
+            values = ','.join(f'{key}="{str(value)}"' for key, value in pairs)
+            return f'{{{values}}}'
+        with self.lock:
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f'# HELP {name} {self.help.get(name, "")}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in histograms.items():
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.buckets):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_bucket{labels_text(labels, [("le", "+Inf")])} {histogram.count}')
+                    lines.append(f'{name}_sum{labels_text(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{labels_text(labels)} {histogram.count}')
+            for name, counters in sorted(self.counters.items()):
+                lines.append(f'# HELP {name} {self.help.get(name, "")}')
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in counters.items():
+                    lines.append(f'{name}{labels_text(labels)} {value}')
+            gauges = list(self.gauges.items())
+        for name, function in sorted(gauges):
+            lines.append(f'# HELP {name} {self.help.get(name, "")}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {function()}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+registry.describe('unisono_handler_seconds', 'Time spent in update handlers')
+registry.describe('unisono_handler_errors_total', 'Update handlers that raised')
+registry.describe('unisono_db_query_seconds', 'Time spent executing database statements')
+registry.describe('unisono_bot_api_seconds', 'Latency of Bot API requests')
+registry.describe('unisono_bot_api_errors_total', 'Bot API requests that failed')
+
+# the statements run by the handler on this thread, as (labels, seconds), see timed_handler
+handler_queries = threading.local()
+
+def timed_handler(callback, name=None):
+    """Wrap an update handler callback to record its duration and errors.
+
+    Calls are profiled while a profiling.profiler session runs, and calls slower than
+    the threshold of profiling.slow_log are logged with the statements they ran.
+    """
+    name = name or callback.__name__
+    @functools.wraps(callback)
+    def wrapper(update, context, *args):
+        started = time.perf_counter()
+        handler_queries.queries = []
+        try:
+            return profiling.profiler.call(callback, update, context, *args)
+        except Exception:
+            registry.inc('unisono_handler_errors_total', handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            registry.observe('unisono_handler_seconds', elapsed, handler=name)
+            profiling.slow_log.check(name, update, elapsed, handler_queries.queries)
+            handler_queries.queries = None
+    return wrapper
+
+def instrument_dispatcher(dispatcher):
+    """Time every handler registered with the dispatcher so far."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if getattr(handler.callback, 'timed', False): continue
+            handler.callback = timed_handler(handler.callback)
+
+table_pattern = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+def statement_labels(statement):
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    match = table_pattern.search(statement)
+    return dict(operation=operation, table=match.group(1) if match else '')
+
+def instrument_engine(engine):
+    """Record the duration of every statement executed through the SQLAlchemy engine."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        labels = statement_labels(statement)
+        registry.observe('unisono_db_query_seconds', elapsed, **labels)
+        queries = getattr(handler_queries, 'queries', None)
+        if queries is not None:
+            queries.append((labels, elapsed))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection else None
+        if started:
+            started.pop()
+
+class TimedRequest(Request):
+    """Request that records the latency and errors of each Bot API method."""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except Exception as e:
+            registry.inc('unisono_bot_api_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            registry.observe('unisono_bot_api_seconds', time.perf_counter() - started, method=method)
+
+def start_http_server(host='127.0.0.1', port=9090):
+    """Serve the registry on http://host:port/metrics from a background thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    return httpd
@@ -1,10 +1,196 @@
 #!/usr/bin/env python
+"""Migrate, export and import the bot's database.
 
-import dataset
+    python migration.py                          # apply pending schema migrations
+    python migration.py export backup/           # every table to backup/<table>.jsonl
+    python migration.py export backup/ --format parquet --tables message rating
+    python migration.py import backup/ --replace # e.g. into a new database_url
 
-db_roaming = dataset.connect('sqlite:///roaming.db')
+Tables are streamed in chunks, with a server-side cursor where the database has them, and
+written in one transaction per chunk, so memory stays bounded and the bot keeps running.
+Parquet files need pyarrow.
+"""
 
-for message in db_roaming['message'].find():
-    if message['published'] == None:
-        message['published'] = True
-    db_roaming['message'].update(message, ['id'])
\ No newline at end of file
+import argparse
+import base64
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import BigInteger, Boolean, Float, Integer, LargeBinary, text
+
+from bot_config import get_bot_config
+import schema
+import storage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10000
+
+def data_tables(db, names=None):
+    # schema_version belongs to the database, the import migrates its own
+    tables = [name for name in db.tables if name != 'schema_version']
+    if not names: return tables
+    unknown = set(names) - set(tables)
+    if unknown:
+        raise SystemExit(f"unknown table(s): {', '.join(sorted(unknown))}")
+    return names
+
+def binary_columns(columns):
+    return [column.name for column in columns if isinstance(column.type, LargeBinary)]
+
+def read_chunks(db, name, chunk_size):
+    """The rows of a table in chunks of dicts, in id order."""
+    table = db[name]
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            table.table.select().order_by(table.table.c.id)
+        )
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows: break
+            yield [dict(row._mapping) for row in rows]
+
+class JsonLines:
+    extension = 'jsonl'
+
+    def write(self, path, chunks, columns):
+        binary = binary_columns(columns)
+        with open(path, 'w') as f:
+            for rows in chunks:
+                for row in rows:
+                    for column in binary:
+                        if row[column] is not None:
+                            row[column] = base64.b64encode(row[column]).decode()
+                    f.write(json.dumps(row))
+                    f.write('\n')
+                yield len(rows)
+
+    def read(self, path, chunk_size, columns):
+        binary = binary_columns(columns)
+        with open(path) as f:
+            rows = []
+            for line in f:
+                row = json.loads(line)
+                for column in binary:
+                    if row.get(column) is not None:
+                        row[column] = base64.b64decode(row[column])
+                rows.append(row)
+                if len(rows) == chunk_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+
+class Parquet:
+    extension = 'parquet'
+
+    def __init__(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("the parquet format needs pyarrow, pip install pyarrow")
+        self.pyarrow = pyarrow
+
+    def arrow_type(self, column):
+        # most specific first, BigInteger is an Integer
+        for sql_type, arrow_type in [
+            (BigInteger, self.pyarrow.int64()),
+            (Integer, self.pyarrow.int64()),
+            (Float, self.pyarrow.float64()),
+            (Boolean, self.pyarrow.bool_()),
+            (LargeBinary, self.pyarrow.binary()),
+        ]:
+            if isinstance(column.type, sql_type): return arrow_type
+        return self.pyarrow.string()
+
+    def write(self, path, chunks, columns):
+        arrow_schema = self.pyarrow.schema([(column.name, self.arrow_type(column)) for column in columns])
+        with self.pyarrow.parquet.ParquetWriter(path, arrow_schema) as writer:
+            for rows in chunks:
+                # one row group per chunk
+                writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=arrow_schema))
+                yield len(rows)
+
+    def read(self, path, chunk_size, columns):
+        for batch in self.pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+
+formats = dict(jsonl=JsonLines, parquet=Parquet)
+
+def report(name, rows, started, path=None):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    size = f", {os.path.getsize(path) / 1e6:.1f} MB" if path and os.path.exists(path) else ''
+    logger.info(f"{name}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:.0f} rows/s{size}")
+
+def export(db, directory, names, file_format, chunk_size):
+    os.makedirs(directory, exist_ok=True)
+    total, started = 0, time.perf_counter()
+    for name in data_tables(db, names):
+        path = os.path.join(directory, f'{name}.{file_format.extension}')
+        table_started, rows = time.perf_counter(), 0
+        for count in file_format.write(path, read_chunks(db, name, chunk_size), db[name].table.columns):
+            rows += count
+        report(name, rows, table_started, path)
+        total += rows
+    report('export', total, started)
+
+def import_(db, directory, names, file_format, chunk_size, replace):
+    schema.migrate(db)
+    total, started = 0, time.perf_counter()
+    for name in data_tables(db, names):
+        path = os.path.join(directory, f'{name}.{file_format.extension}')
+        if not os.path.exists(path):
+            logger.info(f"{name}: no {path}, skipped")
+            continue
+        table = db[name]
+        # rows the migrations seeded would clash with the exported ones
+        if replace or name in schema.seeded_tables:
+            table.delete()
+        table_started, rows = time.perf_counter(), 0
+        for chunk in file_format.read(path, chunk_size, table.table.columns):
+            with db as tx:
+                tx.executable.execute(tx[name].table.insert(), chunk)
+            rows += len(chunk)
+        if db.is_postgres and rows:
+            # the ids were inserted explicitly, move the sequence past them
+            db.query(text(f"SELECT setval(pg_get_serial_sequence('\"{name}\"', 'id'), max(id)) FROM \"{name}\""))
+        report(name, rows, table_started)
+        total += rows
+    for name, seed in schema.seeded_tables.items():
+        if name in data_tables(db, names) and not os.path.exists(os.path.join(directory, f'{name}.{file_format.extension}')):
+            # an older export without the table, fill it from the imported rows instead
+            db[name].delete()
+            seed(db)
+            logger.info(f"{name}: not exported, filled in from the imported tables")
+    report('import', total, started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', nargs='?', choices=['migrate', 'export', 'import'], default='migrate')
+    parser.add_argument('directory', nargs='?', help='directory of the exported files')
+    parser.add_argument('--format', choices=sorted(formats), default='jsonl')
+    parser.add_argument('--tables', nargs='+', help='only these tables')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows per read and transaction')
+    parser.add_argument('--replace', action='store_true', help='delete the rows of imported tables first')
+    args = parser.parse_args()
+    if args.command != 'migrate' and not args.directory:
+        parser.error(f"{args.command} needs a directory")
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    )
+    db_roaming = storage.connect(get_bot_config())
+
+    if args.command == 'export':
+        export(db_roaming, args.directory, args.tables, formats[args.format](), args.chunk_size)
+    elif args.command == 'import':
+        import_(db_roaming, args.directory, args.tables, formats[args.format](), args.chunk_size, args.replace)
+    else:
+        version = schema.migrate(db_roaming)
+        logger.info(f"database is at schema version {version}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# retries of a single message rejected with RetryAfter
+MAX_RETRIES = 5
+# log a warning when this many messages are waiting
+QUEUE_DEPTH_WARNING = 100
+# Telegram's limit for the text of a message, coalesced texts must stay below it
+MAX_TEXT_LENGTH = 4096
+# number of recent deliveries the latency figures are computed from
+LATENCY_WINDOW = 1000
+
+class OutboundMessage:
+    def __init__(self, bot, method, chat_id, kwargs):
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = Future()
+        self.followers = []  # coalesced messages answered with the same result
+        self.retries = 0
+        self.queued = time.monotonic()
+
+    def can_coalesce(self, other):
+        # only plain texts without keyboards can be merged without changing what the user sees
+        return (
+            self.method == other.method == 'send_message' and
+            set(self.kwargs) <= {'text', 'parse_mode'} and
+            set(other.kwargs) <= {'text', 'parse_mode'} and
+            self.kwargs.get('parse_mode') == other.kwargs.get('parse_mode') and
+            len(self.kwargs['text']) + len(other.kwargs['text']) + 2 <= MAX_TEXT_LENGTH
+        )
+
+    def coalesce(self, other):
+        self.kwargs['text'] = f"{self.kwargs['text']}\n\n{other.kwargs['text']}"
+        self.followers.append(other)
+
+    def set_result(self, result):
+        for message in [self] + self.followers:
+            message.future.set_result(result)
+
+    def set_exception(self, exception):
+        for message in [self] + self.followers:
+            message.future.set_exception(exception)
+
+class Outbox:
+    """Central queue for outgoing Bot API calls that keeps within Telegram's flood limits.
+
+    Messages are sent in order per chat, at most `chat_rate` per second and chat (with bursts
+    of `chat_burst`) and `rate` per second overall. Texts piling up for the same chat are
+    merged into one message, and calls rejected with RetryAfter are retried after the
+    requested delay, so load turns into bounded delays instead of errors.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, workers=8):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = dict()  # chat_id -> TokenBucket
+        self.queues = dict()        # chat_id -> deque of OutboundMessage
+        self.in_flight = set()      # chat ids with a message being sent or scheduled
+        self.schedule = []          # heap of (due, sequence, chat_id)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def send(self, bot, method, chat_id, **kwargs):
+        """Queue the call of the Bot method for chat_id and wait for its result."""
+        return self.submit(bot, method, chat_id, **kwargs).result()
+
+    def submit(self, bot, method, chat_id, **kwargs):
+        message = OutboundMessage(bot, method, chat_id, kwargs)
+        with self.condition:
+            self.queues.setdefault(chat_id, deque()).append(message)
+            self.depth += 1
+            if self.depth == QUEUE_DEPTH_WARNING:
+                logger.warning(f"{self.depth} outgoing messages queued")
+            if chat_id not in self.in_flight:
+                self._schedule(chat_id)
+        return message.future
+
+    def _schedule(self, chat_id, delay=0):
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        due = time.monotonic() + max(delay, bucket.reserve())
+        self.in_flight.add(chat_id)
+        heapq.heappush(self.schedule, (due, next(self.sequence), chat_id))
+        self.condition.notify()
+
+    def _prune(self):
+        # buckets of idle chats have refilled completely and can be dropped
+        idle = time.monotonic() - self.chat_burst / self.chat_rate
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.queues and bucket.timestamp < idle:
+                del self.chat_buckets[chat_id]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.chat_buckets) > 2 * len(self.queues) + 1000:
+                    self._prune()
+                while not self.schedule or self.schedule[0][0] > time.monotonic():
+                    self.condition.wait(self.schedule[0][0] - time.monotonic() if self.schedule else None)
+                _, _, chat_id = heapq.heappop(self.schedule)
+                queue = self.queues[chat_id]
+                message = queue.popleft()
+                while queue and message.can_coalesce(queue[0]):
+                    message.coalesce(queue.popleft())
+                    self.coalesced += 1
+                    self.depth -= 1
+            # the global limit paces the whole queue, so waiting for it here is fine
+            self.bucket.acquire()
+            self.pool.submit(self._deliver, message)
+
+    def _deliver(self, message):
+        try:
+            result = getattr(Bot, message.method)(message.bot, chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            if message.retries < MAX_RETRIES:
+                logger.warning(f"flood limit for chat {message.chat_id}, retrying in {e.retry_after}s")
+                message.retries += 1
+                with self.condition:
+                    self.retried += 1
+                    self.queues[message.chat_id].appendleft(message)
+                    self._schedule(message.chat_id, e.retry_after)
+                return
+            self._done(message, exception=e)
+        except Exception as e:
+            self._done(message, exception=e)
+        else:
+            self._done(message, result=result)
+
+    def _done(self, message, result=None, exception=None):
+        with self.condition:
+            self.depth -= 1
+            if exception:
+                self.failed += 1
+            else:
+                self.sent += 1
+            self.latencies.append(time.monotonic() - message.queued)
+            self.in_flight.discard(message.chat_id)
+            if self.queues[message.chat_id]:
+                self._schedule(message.chat_id)
+            else:
+                del self.queues[message.chat_id]
+        if exception:
+            message.set_exception(exception)
+        else:
+            message.set_result(result)
+
+    def stats(self):
+        with self.condition:
+            latencies = sorted(self.latencies)
+            return dict(
+                depth=self.depth,
+                sent=self.sent,
+                failed=self.failed,
+                retried=self.retried,
+                coalesced=self.coalesced,
+                latency_p50=latencies[len(latencies) // 2] if latencies else 0,
+                latency_max=latencies[-1] if latencies else 0,
+            )
+
+class QueuedBot(Bot):
+    """Bot whose messages to chats go through an Outbox."""
+
+    def __init__(self, *args, outbox=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._outbox = outbox or Outbox()
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._outbox.send(self, 'send_message', chat_id, text=text, **kwargs)
+
+    def send_voice(self, chat_id, voice, **kwargs):
+        return self._outbox.send(self, 'send_voice', chat_id, voice=voice, **kwargs)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import json
+from collections import defaultdict
+
+from sqlalchemy import text
+from telegram.ext import BasePersistence
+
+from writer import BufferedWriter
+
+# table -> (key column, insert, update)
+queries = {
+    'chat_data': (
+        'chat_id',
+        text("INSERT INTO chat_data (chat_id, data) VALUES (:id, :data);"),
+        text("UPDATE chat_data SET data = :data WHERE chat_id = :id;"),
+    ),
+    'user_data': (
+        'user_id',
+        text("INSERT INTO user_data (user_id, data) VALUES (:id, :data);"),
+        text("UPDATE user_data SET data = :data WHERE user_id = :id;"),
+    ),
+}
+
+class DatabasePersistence(BasePersistence):
+    """context.chat_data and context.user_data stored as one JSON document per chat and user.
+
+    The documents are kept in memory as last written. A changed document is written by a
+    background thread at most `flush_interval` seconds later, in one transaction with all
+    other changes of that interval, so a tap costs no write of its own. flush() writes
+    them right away; the Updater calls it on shutdown. Chats and users that never stored
+    anything get no row.
+    """
+
+    def __init__(self, db, flush_interval=1):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.db = db
+        self.flush_interval = flush_interval
+        # pending: (table, id) -> JSON document not written yet
+        self.writer = BufferedWriter('persistence', self._write, self._requeue, delay=flush_interval)
+        self.documents = dict()  # (table, id) -> JSON document, as written or about to be
+        self.stored = set()      # (table, id) that have a row
+
+    def _load(self, table):
+        key = queries[table][0]
+        data = defaultdict(dict)
+        for row in self.db[table].all():
+            data[row[key]] = json.loads(row['data'])
+            with self.writer.condition:
+                self.documents[(table, row[key])] = row['data']
+                self.stored.add((table, row[key]))
+        return data
+
+    def reset(self, dispatcher):
+        """Forget all chat and user data, here and in the dispatcher, after their tables were emptied."""
+        with self.writer.write_lock:
+            with self.writer.condition:
+                self.documents.clear()
+                self.stored.clear()
+                self.writer.pending.clear()
+            # the dispatcher holds copies of what get_chat_data and get_user_data returned
+            dispatcher.chat_data.clear()
+            dispatcher.user_data.clear()
+
+    def _update(self, table, id, data):
+        document = json.dumps(data, sort_keys=True)
+        with self.writer.condition:
+            if self.documents.get((table, id), '{}') == document: return
+            self.documents[(table, id)] = document
+            self.writer.pending[(table, id)] = document
+            self.writer.added()
+
+    def flush(self):
+        self.writer.flush()
+
+    def _write(self, pending):
+        with self.db as tx:
+            for table, (_, insert_query, update_query) in queries.items():
+                inserts = [
+                    dict(id=id, data=document) for (t, id), document in pending.items()
+                    if t == table and (t, id) not in self.stored
+                ]
+                updates = [
+                    dict(id=id, data=document) for (t, id), document in pending.items()
+                    if t == table and (t, id) in self.stored
+                ]
+                if inserts:
+                    tx.executable.execute(insert_query, inserts)
+                if updates:
+                    tx.executable.execute(update_query, updates)
+        with self.writer.condition:
+            self.stored.update(pending)
+
+    def _requeue(self, failed, pending):
+        # keep them for the next attempt, unless they changed again meanwhile
+        for key, document in failed.items():
+            pending.setdefault(key, document)
+
+    def get_chat_data(self):
+        return self._load('chat_data')
+
+    def get_user_data(self):
+        return self._load('user_data')
+
+    def update_chat_data(self, chat_id, data):
+        self._update('chat_data', chat_id, data)
+
+    def update_user_data(self, user_id, data):
+        self._update('user_data', user_id, data)
+
+    def get_bot_data(self):
+        return dict()
+
+    def get_conversations(self, name):
+        return dict()
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+    """cProfile of the handler calls of one session, across all dispatcher worker threads.
+
+    A session is started with start() and ends after `updates` handler calls or
+    `seconds`, whichever comes first, or with stop(). Each handler call is profiled on
+    its own and the calls are added up, so threads that are not running a handler
+    (polling, outbox, writers) are not included. When it ends, `on_done` is called with
+    the report.
+    """
+
+    def __init__(self, limit=25):
+        self.limit = limit  # functions in a report
+        self.lock = threading.Lock()
+        self.active = False
+        self.stats = None
+        self.calls = 0
+        self.updates = None
+        self.on_done = None
+        self.timer = None
+
+    def start(self, on_done, updates=None, seconds=60):
+        """Start a session, return False if one is running already."""
+        with self.lock:
+            if self.active: return False
+            self.active = True
+            self.stats = None
+            self.calls = 0
+            self.updates = updates
+            self.on_done = on_done
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        return True
+
+    def stop(self):
+        """End the session and pass its report on, if there is one."""
+        with self.lock:
+            if not self.active: return
+            self.active = False
+            self.timer.cancel()
+            stats, calls, on_done = self.stats, self.calls, self.on_done
+        on_done(self.report(stats, calls))
+
+    def report(self, stats, calls):
+        if not stats: return "no updates were handled while profiling"
+        out = io.StringIO()
+        stats.stream = out
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self.limit)
+        # drop the header pstats prints before the table
+        table = out.getvalue()
+        return f"{calls} handler call(s)\n" + table[table.find('   ncalls'):]
+
+    def call(self, callback, *args):
+        """Run a handler callback, profiled if a session is running."""
+        if not self.active: return callback(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles one thread at a time, this call is left out
+            return callback(*args)
+        try:
+            return callback(*args)
+        finally:
+            profile.disable()
+            self._add(profile)
+
+    def _add(self, profile):
+        with self.lock:
+            if not self.active: return
+            if self.stats:
+                self.stats.add(profile)
+            else:
+                self.stats = pstats.Stats(profile)
+            self.calls += 1
+            done = self.updates and self.calls >= self.updates
+        if done:
+            self.stop()
+
+class SlowLog:
+    """The last `size` handler calls that took longer than `threshold` seconds.
+
+    Each is logged as a warning, with the statements the handler ran grouped by
+    operation and table.
+    """
+
+    def __init__(self, threshold=1.0, size=20):
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+
+    def check(self, name, update, elapsed, queries):
+        if self.threshold is None or elapsed < self.threshold: return
+        grouped = dict()  # (operation, table) -> [count, seconds]
+        for labels, seconds in queries or []:
+            counts = grouped.setdefault((labels['operation'], labels['table']), [0, 0.0])
+            counts[0] += 1
+            counts[1] += seconds
+        chat = getattr(update, 'effective_chat', None)
+        entry = dict(
+            handler=name,
+            chat_id=chat.id if chat else None,
+            utc_timestamp=time.time(),
+            seconds=elapsed,
+            db_seconds=sum(seconds for _, seconds in grouped.values()),
+            queries=sorted(((operation, table, count, seconds) for (operation, table), (count, seconds) in grouped.items()), key=lambda q: -q[3]),
+        )
+        self.entries.append(entry)
+        logger.warning(format_slow_update(entry))
+
+def format_slow_update(entry):
+    text = (
+        f"slow update: {entry['handler']} for chat {entry['chat_id']} took {entry['seconds']*1000:.0f}ms, "
+        f"{entry['db_seconds']*1000:.1f}ms in {sum(q[2] for q in entry['queries'])} queries"
+    )
+    for operation, table, count, seconds in entry['queries'][:5]:
+        text += f"\n  {operation} {table}: {count}, {seconds*1000:.1f}ms"
+    return text
+
+profiler = Profiler()
+slow_log = SlowLog()
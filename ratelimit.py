@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average with bursts of up to `capacity`.
+
+    Tokens are reserved up front, so concurrent callers are spaced out evenly instead of
+    all waking up at the same time once the bucket refills.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before using it."""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold back all acquisitions for at least `seconds`, e.g. after a RetryAfter."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+from writer import BufferedWriter
+
+class RatingWriter:
+    """Write-behind buffer for rating rows.
+
+    Ratings are inserted in batches of up to `max_batch` rows with a single commit, at the
+    latest `max_delay` seconds after the first row of a batch was added. Readers that need
+    every rating in the table call flush() first.
+    """
+
+    def __init__(self, db, max_batch=100, max_delay=0.05):
+        self.db = db
+        self.writer = BufferedWriter('rating_writer', self._write, self._requeue, new=list, delay=max_delay, max_batch=max_batch)
+
+    def add(self, row):
+        with self.writer.condition:
+            self.writer.pending.append(row)
+            self.writer.added()
+
+    def flush(self):
+        """Write all ratings added so far."""
+        self.writer.flush()
+
+    def discard(self):
+        self.writer.discard()
+
+    def _write(self, rows):
+        with self.db as tx:
+            # executemany on this thread's connection, dataset's insert_many would use the
+            # connection of whichever thread loaded the table first
+            tx.executable.execute(tx['rating'].table.insert(), rows)
+
+    def _requeue(self, rows, pending):
+        # before the ones added meanwhile, to keep their order
+        pending[:0] = rows
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+# parsed once, SQLAlchemy caches the compiled form of each statement
+user_query = text('SELECT * FROM "user" WHERE chat_id = :chat_id LIMIT 1;')
+message_query = text('SELECT * FROM message WHERE message_id = :message_id LIMIT 1;')
+message_by_id_query = text('SELECT * FROM message WHERE id = :id LIMIT 1;')
+published_message_query = text("""
+SELECT 1 FROM message WHERE chat_id = :chat_id AND topic = :topic AND published = :published LIMIT 1;
+""")
+publish_query = text("""
+UPDATE message SET published = :published WHERE message_id = :message_id AND chat_id = :chat_id;
+""")
+topic_query = text("""
+UPDATE message SET topic = :topic WHERE message_id = :message_id AND chat_id = :chat_id AND published = :published;
+""")
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class Repository:
+    """User and message lookups of the handlers, with recently used rows kept in memory.
+
+    Users never change and messages only change through the methods below, which drop
+    the cached row, so a cached row is the same as the one in the database. Misses are
+    not cached, a row may be inserted by the next update.
+    """
+
+    def __init__(self, db, cache_size=10000):
+        self.db = db
+        self.users = LRUCache(cache_size)     # chat_id -> user
+        self.messages = LRUCache(cache_size)  # message_id -> message
+        self.message_ids = LRUCache(cache_size)  # row id -> message_id
+
+    def reset(self):
+        self.users.clear()
+        self.messages.clear()
+        self.message_ids.clear()
+
+    def _one(self, query, **params):
+        for row in self.db.query(query, **params):
+            return dict(row)
+        return None
+
+    def get_user(self, chat_id):
+        user = self.users.get(chat_id)
+        if user is None:
+            user = self._one(user_query, chat_id=chat_id)
+            if user is None: return None
+            self.users.put(chat_id, user)
+        return dict(user)
+
+    def add_user(self, user):
+        """Insert the user unless it exists, return True if it was new."""
+        if self.get_user(user['chat_id']): return False
+        self.db['user'].upsert(user, ['chat_id'])
+        return True
+
+    def get_message(self, message_id, chat_id=None):
+        """The message, if chat_id is given only if it was sent by that chat."""
+        message = self.messages.get(message_id)
+        if message is None:
+            message = self._one(message_query, message_id=message_id)
+            if message is None: return None
+            self.messages.put(message_id, message)
+        if chat_id is not None and message['chat_id'] != chat_id: return None
+        return dict(message)
+
+    def get_message_by_id(self, id):
+        """The message with row id `id`, as used in callback_data."""
+        message_id = self.message_ids.get(id)
+        if message_id is not None:
+            return self.get_message(message_id)
+        message = self._one(message_by_id_query, id=id)
+        if message is None: return None
+        self.message_ids.put(id, message['message_id'])
+        self.messages.put(message['message_id'], message)
+        return dict(message)
+
+    def add_message(self, message):
+        """Insert the message and return its row id."""
+        return self.db['message'].insert(message)
+
+    def has_published_message(self, chat_id, topic='general'):
+        return self._one(published_message_query, chat_id=chat_id, topic=topic, published=True) is not None
+
+    def publish_message(self, message_id, chat_id):
+        """Publish a message of chat_id and return it."""
+        with self.db as tx:
+            tx.executable.execute(publish_query, message_id=message_id, chat_id=chat_id, published=True)
+        self.messages.pop(message_id)
+        return self.get_message(message_id, chat_id)
+
+    def set_message_topic(self, message_id, chat_id, topic):
+        """Set the topic of an unpublished message of chat_id and return it, None if there is none."""
+        with self.db as tx:
+            updated = tx.executable.execute(topic_query, message_id=message_id, chat_id=chat_id, topic=topic, published=False).rowcount
+        self.messages.pop(message_id)
+        return self.get_message(message_id, chat_id) if updated else None
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+import logging
+
+from sqlalchemy import LargeBinary
+
+logger = logging.getLogger(__name__)
+
+def tables(types):
+    return {
+        'user': [
+            ('chat_id', types.bigint),
+        ],
+        'message': [
+            ('message_id', types.text),
+            ('chat_id', types.bigint),
+            ('data', types.text),
+            ('published', types.boolean),
+            ('topic', types.text),
+            ('typ', types.text),
+            ('origin', types.text),
+            ('utc_timestamp', types.float),
+        ],
+        'rating': [
+            ('from_id', types.bigint),
+            ('to_id', types.bigint),
+            ('message_id', types.text),
+            ('rating', types.integer),
+            ('utc_timestamp', types.float),
+        ],
+        'broadcast': [
+            ('name', types.text),
+            ('text', types.text),
+            ('reply_markup', types.text),
+            ('parse_mode', types.text),
+            ('status', types.text),
+            ('utc_timestamp', types.float),
+        ],
+        'broadcast_recipient': [
+            ('broadcast_id', types.integer),
+            ('chat_id', types.bigint),
+            ('status', types.text),
+            ('error', types.text),
+        ],
+        'user_like': [
+            ('from_id', types.bigint),
+            ('to_id', types.bigint),
+            ('utc_timestamp', types.float),
+        ],
+        'user_match': [
+            ('user_a', types.bigint),
+            ('user_b', types.bigint),
+            ('utc_timestamp', types.float),
+        ],
+        # dislikes moved out of rating by compaction
+        'rating_archive': [
+            ('from_id', types.bigint),
+            ('to_id', types.bigint),
+            ('message_id', types.text),
+            ('rating', types.integer),
+            ('utc_timestamp', types.float),
+        ],
+        # row ids of the messages in rating_archive per user, see compaction.encode_ids
+        'user_seen': [
+            ('chat_id', types.bigint),
+            ('message_rows', LargeBinary),
+            ('message_count', types.integer),
+            ('utc_timestamp', types.float),
+        ],
+        # most liked notes, see examples.ExamplePool
+        'example': [
+            ('message_id', types.text),
+            ('chat_id', types.bigint),
+            ('data', types.text),
+            ('likes', types.integer),
+            ('utc_timestamp', types.float),
+        ],
+        # context.chat_data and context.user_data as JSON, see persistence.DatabasePersistence
+        'chat_data': [
+            ('chat_id', types.bigint),
+            ('data', types.text),
+        ],
+        'user_data': [
+            ('user_id', types.bigint),
+            ('data', types.text),
+        ],
+        # event counts per hour and in total (bucket 0), see counters.Counters
+        'stat_counter': [
+            ('name', types.text),
+            ('bucket', types.bigint),
+            ('value', types.bigint),
+        ],
+        # file_ids of re-uploaded voices from bot_config, see voices.VoiceAssets
+        'voice_asset': [
+            ('name', types.text),
+            ('configured', types.text),
+            ('file_id', types.text),
+            ('utc_timestamp', types.float),
+        ],
+    }
+
+indexes = [
+    ('user', ['chat_id']),
+    ('message', ['message_id']),
+    # latest published message per (chat_id, topic) and the replace check in handle_voice_msg
+    ('message', ['chat_id', 'topic', 'published', 'utc_timestamp']),
+    # a user's ratings, and the mutual like lookup in rating_yes
+    ('rating', ['from_id', 'to_id', 'rating']),
+    ('broadcast_recipient', ['broadcast_id', 'status']),
+    # old dislikes picked by compaction
+    ('rating', ['rating', 'utc_timestamp']),
+    ('rating_archive', ['from_id']),
+    # who liked a viewer, for ranking
+    ('user_like', ['to_id']),
+]
+
+unique_indexes = [
+    ('user_like', ['from_id', 'to_id']),
+    # user_a is the smaller chat id of the pair
+    ('user_match', ['user_a', 'user_b']),
+    ('user_seen', ['chat_id']),
+    ('chat_data', ['chat_id']),
+    ('user_data', ['user_id']),
+    ('voice_asset', ['name']),
+    ('stat_counter', ['name', 'bucket']),
+]
+
+def create_tables(db):
+    """Create the tables with typed columns, adding columns missing from older databases."""
+    for name, columns in tables(db.types).items():
+        table = db.create_table(name)
+        for column, typ in columns:
+            table.create_column(column, typ)
+
+def publish_legacy_messages(db):
+    """Messages from before the publish step have no published flag, they count as published."""
+    db.query("UPDATE message SET published = :published WHERE published IS NULL", published=True)
+
+def type_published_column(db):
+    """published was created as a text column by early inserts and compared as the string '1'."""
+    column = db['message'].table.c['published']
+    if isinstance(column.type, db.types.boolean): return
+    with db.op.batch_alter_table('message') as batch:
+        batch.alter_column('published', type_=db.types.boolean(), existing_type=column.type)
+
+def create_indexes(db):
+    for name, columns in indexes:
+        db[name].create_index(columns, name=f"ix_{name}_{'_'.join(columns)}")
+    for name, columns in unique_indexes:
+        db[name].create_index(columns, name=f"ux_{name}_{'_'.join(columns)}", unique=True)
+
+def backfill_likes(db):
+    """Fill user_like and user_match from the positive ratings given so far."""
+    db.query("""
+        INSERT INTO user_like (from_id, to_id, utc_timestamp)
+        SELECT from_id, to_id, min(utc_timestamp) FROM rating
+        WHERE rating = 1 AND NOT EXISTS (
+            SELECT 1 FROM user_like AS l WHERE l.from_id = rating.from_id AND l.to_id = rating.to_id
+        )
+        GROUP BY from_id, to_id
+    """)
+    db.query("""
+        INSERT INTO user_match (user_a, user_b, utc_timestamp)
+        SELECT a.from_id, a.to_id, CASE WHEN a.utc_timestamp > b.utc_timestamp THEN a.utc_timestamp ELSE b.utc_timestamp END
+        FROM user_like AS a INNER JOIN user_like AS b ON a.from_id = b.to_id AND a.to_id = b.from_id
+        WHERE a.from_id < a.to_id AND NOT EXISTS (
+            SELECT 1 FROM user_match AS m WHERE m.user_a = a.from_id AND m.user_b = a.to_id
+        )
+    """)
+
+# counter -> SQL expression of its total so far
+counter_totals = [
+    ('users', 'SELECT count(*) FROM "user"'),
+    ('notes_recorded', 'SELECT count(*) FROM message'),
+    ('notes_published', 'SELECT count(*) FROM message WHERE published = :published'),
+    ('reactions', "SELECT count(*) FROM message WHERE topic != 'general'"),
+    ('likes', 'SELECT count(*) FROM rating WHERE rating = 1'),
+    ('dislikes', '(SELECT count(*) FROM rating WHERE rating = -1) + (SELECT count(*) FROM rating_archive)'),
+    ('matches', 'SELECT count(*) FROM user_match'),
+]
+
+def backfill_counters(db):
+    """Start the totals in stat_counter at what the tables held before counting began."""
+    for name, total in counter_totals:
+        db.query(f"INSERT INTO stat_counter (name, bucket, value) SELECT :name, 0, ({total})", name=name, published=True)
+
+# tables the migrations fill in, an import replaces their rows -> function to fill them again
+seeded_tables = {
+    'stat_counter': backfill_counters,
+}
+
+# append only, the position in this list is the schema version
+migrations = [
+    create_tables,
+    publish_legacy_messages,
+    type_published_column,
+    create_indexes,
+    # broadcast tables
+    create_tables,
+    create_indexes,
+    # likes graph
+    create_tables,
+    create_indexes,
+    backfill_likes,
+    # rating compaction
+    create_tables,
+    create_indexes,
+    # example pool
+    create_tables,
+    # chat data
+    create_tables,
+    create_indexes,
+    # user data
+    create_tables,
+    create_indexes,
+    # voice assets
+    create_tables,
+    create_indexes,
+    # stat counters
+    create_tables,
+    create_indexes,
+    backfill_counters,
+    # ranking
+    create_indexes,
+]
+
+def get_schema_version(db):
+    versions = db.create_table('schema_version')
+    versions.create_column('version', db.types.integer)
+    row = next(iter(db.query("SELECT max(version) AS version FROM schema_version")))
+    return row['version'] or 0
+
+def migrate(db):
+    """Apply all migrations newer than the schema version recorded in the database."""
+    version = get_schema_version(db)
+    for number, migration in enumerate(migrations[version:], start=version+1):
+        logger.info(f"migrating database to version {number}: {migration.__name__}")
+        with db as tx:
+            migration(tx)
+            tx['schema_version'].insert(dict(version=number))
+        # reflect the altered tables again on next use
+        db._flush_tables()
+    return len(migrations)
@@ -1,17 +1,41 @@
 #!/usr/bin/env python
 
 from bot_config import get_bot_config
+from candidates import CandidateIndex
+from feed import Feed
+from broadcast import Broadcaster
+from outbox import Outbox, QueuedBot
+from likes import LikesGraph
+from ratings import RatingWriter
+from compaction import RatingCompactor
+from examples import ExamplePool
+from persistence import DatabasePersistence
+from cluster import ChatLanes, Intake
+from voices import VoiceAssets
+from counters import Counters
+from ratelimit import TokenBucket
+from repository import Repository
+from callbacks import CallbackRouter
+import callbacks
+import metrics
+import profiling
+import schema
+import storage
 
 import html
 import json
 import logging
 import traceback
-import dataset
+import signal
+import queue
+import os
 import random
 import hashlib
 import uuid
 import datetime
 from datetime import timezone
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import (
     ParseMode,
@@ -23,6 +47,7 @@ from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     Filters,
     CallbackContext,
     CallbackQueryHandler,
@@ -77,12 +102,83 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db_roaming = dataset.connect('sqlite:///roaming.db')
-
 # This can be your own ID, or one for a developer group/channel.
 # You can use the /start command of this bot to see your chat id.
 bot_config = get_bot_config()
 
+db_roaming = storage.connect(bot_config)
+metrics.instrument_engine(db_roaming.engine)
+# handler calls slower than this are logged with their queries and listed by /slow
+profiling.slow_log.threshold = bot_config.get('slow_update_seconds', 1)
+repository = Repository(db_roaming, cache_size=bot_config.get('repository_cache_size', 10000))
+candidate_index = CandidateIndex(
+    db_roaming,
+    half_life=bot_config.get('ranking_half_life_days', 7) * 24 * 3600,
+    reciprocity_boost=bot_config.get('ranking_reciprocity_boost', 3),
+)
+feed = Feed(candidate_index)
+likes_graph = LikesGraph(db_roaming)
+
+# Bot API calls to different chats don't depend on each other and are sent concurrently
+bot_api_pool = ThreadPoolExecutor(max_workers=bot_config.get('bot_api_workers', 8), thread_name_prefix='bot_api')
+
+# All messages to chats are queued here to stay within Telegram's flood limits
+outbox = Outbox(
+    rate=bot_config.get('outbox_rate', 30),
+    chat_rate=bot_config.get('outbox_chat_rate', 1),
+    chat_burst=bot_config.get('outbox_chat_burst', 3),
+    workers=bot_config.get('outbox_workers', 8),
+)
+
+# Ratings are written in small batches, one commit for all swipes within rating_batch_delay seconds
+rating_writer = RatingWriter(
+    db_roaming,
+    max_batch=bot_config.get('rating_batch_size', 100),
+    max_delay=bot_config.get('rating_batch_delay', 0.05),
+)
+
+# Dislikes older than rating_ttl_days only tell that a note was seen, they are compacted hourly
+rating_compactor = RatingCompactor(
+    db_roaming,
+    ttl=bot_config.get('rating_ttl_days', 30) * 24 * 3600,
+    interval=bot_config.get('rating_compaction_interval', 3600),
+)
+
+# Most liked notes played as examples by first_message_help
+example_pool = ExamplePool(
+    db_roaming,
+    size=bot_config.get('example_pool_size', 100),
+    interval=bot_config.get('example_pool_interval', 600),
+)
+
+# context.chat_data and user_data survive restarts and are available to whichever process
+# handles the chat, changes are written together every persistence_flush_interval seconds
+persistence = DatabasePersistence(db_roaming, flush_interval=bot_config.get('persistence_flush_interval', 1))
+
+# Voices from bot_config sent to every new user, with a local copy in case their file_id expires
+voices = VoiceAssets(
+    db_roaming,
+    dict(welcome_message=bot_config['welcome_message'], first_message_help=bot_config['first_message_help']),
+    cache_dir=bot_config.get('voice_cache_dir', 'voice_cache'),
+)
+
+# Totals and hourly counts of users, notes, swipes and matches for /stats
+counters = Counters(db_roaming, flush_interval=bot_config.get('counters_flush_interval', 5))
+
+# In a worker process, the queue for events the other workers need to know about
+cluster_events = None
+worker_number = None
+
+metrics.registry.gauge('unisono_outbox_queue_depth', lambda: outbox.stats()['depth'], 'Messages waiting in the outbox')
+metrics.registry.gauge('unisono_rating_buffer_size', lambda: len(rating_writer.writer.pending), 'Ratings not written yet')
+
+broadcaster = Broadcaster(
+    db_roaming,
+    # leave room in the outbox for interactive messages
+    rate=bot_config.get('broadcast_rate', 20),
+    workers=bot_config.get('broadcast_workers', 4),
+)
+
 def get_utc_timestamp():
     dt = datetime.datetime.now(timezone.utc)
     utc_time = dt.replace(tzinfo=timezone.utc)
@@ -104,41 +200,44 @@ def rating_model(from_id=0, to_id=0, message_id=0, rating=-1, utc_timestamp=None
         utc_timestamp = get_utc_timestamp()
     return dict(from_id=from_id, to_id=to_id, message_id=message_id, rating=rating, utc_timestamp=utc_timestamp)
 
-def send_note(bot, chat_id, message_id, data):
-    keyboard = [[
-        InlineKeyboardButton('Next', callback_data=f'N{message_id}'),
-        InlineKeyboardButton('Like', callback_data=f'Y{message_id}')
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_voice(chat_id=chat_id, voice=data, reply_markup=reply_markup)
+def send_concurrently(*sequences):
+    """Run the Bot API calls of each sequence in order and the sequences concurrently, wait for all."""
+    def run(calls):
+        for call in calls:
+            call()
+    futures = [bot_api_pool.submit(run, calls) for calls in sequences]
+    for future in futures:
+        future.result()
+
+def announce(kind, payload=None):
+    """Tell the other worker processes, if any, about a change to their in-memory state."""
+    if cluster_events:
+        cluster_events.put((worker_number, kind, payload))
+
+def publish_note(message):
+    feed.publish(message)
+    announce('publish', dict(message))
+
+def note_keyboard(message):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton('Next', callback_data=callbacks.encode(callbacks.NEXT, message['id'])),
+        InlineKeyboardButton('Like', callback_data=callbacks.encode(callbacks.LIKE, message['id']))
+    ]])
+
+def send_note(bot, chat_id, message):
+    voices.send(bot, chat_id, message['data'], reply_markup=note_keyboard(message))
 
 def send_random_note(bot, chat_id):
-    user = db_roaming['user'].find_one(chat_id=chat_id)
+    user = repository.get_user(chat_id)
     if not user:
         raise(Exception("user unknown"))
 
-    rating_msg_ids = set([rating['message_id'] for rating in db_roaming['rating'].find(from_id=chat_id)])
-    
-    messages = dict()
-    query = f"""
-    SELECT m.chat_id, m.topic, m.message_id, m.data
-    FROM (
-        select chat_id, topic, max(utc_timestamp) as max_utc_timestamp
-        from message
-        where chat_id <> '{chat_id}' and published = '1'
-        group by chat_id, topic
-    ) as x inner join message as m on m.chat_id = x.chat_id and m.topic = x.topic and m.utc_timestamp = x.max_utc_timestamp;
-    """
-    for msg in db_roaming.query(query):
-        if msg['message_id'] in rating_msg_ids: continue # exclude messages that have been rated before
-        messages[msg['message_id']] = msg['data']
-    
-    if len(messages):
-        random_msg_id = random.choice(list(messages.keys()))
-        send_note(bot, chat_id=chat_id, message_id=random_msg_id, data=messages[random_msg_id])
+    message = feed.next(chat_id)
+    if message:
+        send_note(bot, chat_id, message)
     else:
         keyboard = [[
-            InlineKeyboardButton('Check Again', callback_data=f'M')
+            InlineKeyboardButton('Check Again', callback_data=callbacks.encode(callbacks.MORE))
         ]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         bot.send_message(chat_id=chat_id, text="There are no messages that you haven't yet seen.", reply_markup=reply_markup)
@@ -168,95 +267,88 @@ def error_handler(update: object, context: CallbackContext) -> None:
     # Finally, send the message
     context.bot.send_message(chat_id=bot_config['developer_chat_id'], text=message, parse_mode=ParseMode.HTML)
 
-def rating_yes(update: Update, context: CallbackContext):
+def rating_yes(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    content = query.data[1:]
-    if not content:
-        raise(Exception("malformed rating command. no content"))
-    message_id = content
-    receiver = db_roaming['user'].find_one(chat_id=chat_id)
+    message_id = message['message_id']
+    receiver = repository.get_user(chat_id)
     if not receiver:
         raise(Exception("invalid chat_id"))
-    message = db_roaming['message'].find_one(message_id=message_id)
-    if not message:
-        raise(Exception("invalid message_id"))
-    sender = db_roaming['user'].find_one(chat_id=message['chat_id'])
+    sender = repository.get_user(message['chat_id'])
     if not sender:
         raise(Exception("invalid chat_id connected with message"))
     
-    db_roaming['rating'].insert(rating_model(from_id=chat_id, to_id=sender['chat_id'], message_id=message_id, rating=1))
+    rating = rating_model(from_id=chat_id, to_id=sender['chat_id'], message_id=message_id, rating=1)
+    rating_writer.add(rating)
+    feed.add_rating(rating)
+    counters.inc('likes')
 
-    sender_ratings = list(db_roaming['rating'].find(from_id=sender['chat_id'], to_id=chat_id, rating=1))
-    mutual_like = True if len(sender_ratings) else False
+    mutual_like = likes_graph.like(chat_id, sender['chat_id'])
     if mutual_like:
-        text = (
+        counters.inc('matches')
+        receiver_text = (
             f"<b>You got a match with: {message['origin']}</b>\n"
             f"Check out their profile and hop on a voice call!"
         )
-        context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
-        
-        text = (
+        sender_text = (
             f"<b>You got a match with: {update.callback_query.from_user.mention_html()}</b>\n"
             f"Check out their profile and hop on a voice call!\n"
             f"For you to recall, hear their voice again:"
         )
-        context.bot.send_message(chat_id=sender['chat_id'], text=text, parse_mode=ParseMode.HTML)
-        for sender_rating_msg_id in set([rating['message_id'] for rating in sender_ratings]):
-            receiver_message = db_roaming['message'].find_one(message_id=sender_rating_msg_id)
-            context.bot.send_voice(chat_id=sender['chat_id'], voice=receiver_message['data'])
-        text = (
+        # the sender's like may have been a moment ago and still be buffered
+        rating_writer.flush()
+        receiver_messages = likes_graph.liked_messages(sender['chat_id'], chat_id)
+        feedback_text = (
             '<i>Any thoughts about Unisono? Tell me in the <a href="https://t.me/Unisono_Feedback">Feedback Group</a></i>'
         )
-        context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
-        context.bot.send_message(chat_id=sender['chat_id'], text=text, parse_mode=ParseMode.HTML)
+        send_concurrently(
+            [
+                partial(context.bot.send_message, chat_id=chat_id, text=receiver_text, parse_mode=ParseMode.HTML),
+                partial(context.bot.send_message, chat_id=chat_id, text=feedback_text, parse_mode=ParseMode.HTML),
+            ],
+            [partial(context.bot.send_message, chat_id=sender['chat_id'], text=sender_text, parse_mode=ParseMode.HTML)] +
+            [partial(voices.send, context.bot, sender['chat_id'], receiver_message['data']) for receiver_message in receiver_messages] +
+            [partial(context.bot.send_message, chat_id=sender['chat_id'], text=feedback_text, parse_mode=ParseMode.HTML)],
+        )
     else:
-        text = (
+        receiver_text = (
             "You liked this message.\n"
             "Eager to <b>Share your reaction</b>?\n"
         )
         keyboard = [
-            [InlineKeyboardButton('Yes!!', callback_data=f'LRY{message_id}')],
-            [InlineKeyboardButton('Check for more messages', callback_data=f'M')]
+            [InlineKeyboardButton('Yes!!', callback_data=callbacks.encode(callbacks.REACT_LIKE, message['id']))],
+            [InlineKeyboardButton('Check for more messages', callback_data=callbacks.encode(callbacks.MORE))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-
-        text = (
+        sender_text = (
             f"Someone just listened to your voice and liked it!"
         )
-        context.bot.send_message(chat_id=sender['chat_id'], text=text, parse_mode=ParseMode.HTML)
+        send_concurrently(
+            [partial(context.bot.send_message, chat_id=chat_id, text=receiver_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)],
+            [partial(context.bot.send_message, chat_id=sender['chat_id'], text=sender_text, parse_mode=ParseMode.HTML)],
+        )
 
-def like_reaction_yes(update: Update, context: CallbackContext):
+def like_reaction_yes(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
-    message_id = query.data[3:]
-    context.chat_data['liked_message_id'] = message_id
+    context.chat_data['liked_message_id'] = message['message_id']
     context.bot.send_message(query.message.chat.id, text="Hit the record button now and I'll deliver it directly.")
 
 def next_message(update: Update, context: CallbackContext):
     query=update.callback_query
-    query.answer()
     chat_id = query.message.chat.id
     send_random_note(context.bot, chat_id)
 
-def rating_no(update: Update, context: CallbackContext):
+def rating_no(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    content = query.data[1:]
-    if not content:
-        raise(Exception("malformed rating command. no content"))
-    message_id = content
-    
-    message = db_roaming['message'].find_one(message_id=message_id)
-    if not message:
-        raise(Exception("invalid message_id"))
+    message_id = message['message_id']
     
-    db_roaming['rating'].insert(rating_model(from_id=chat_id, to_id=message['chat_id'], message_id=message_id, rating=-1))
+    rating = rating_model(from_id=chat_id, to_id=message['chat_id'], message_id=message_id, rating=-1)
+    rating_writer.add(rating)
+    feed.add_rating(rating)
+    counters.inc('dislikes')
     
     send_random_note(context.bot, update.effective_chat.id)
 
@@ -274,29 +366,28 @@ def handle_voice_msg(update:Update, context: CallbackContext):
         update.message.reply_text(text=text, parse_mode=ParseMode.HTML)
         return
 
-    user = db_roaming['user'].find_one(chat_id=chat_id)
-    if not user:
-        user = user_model(chat_id=update.effective_chat.id)
-        db_roaming['user'].upsert(user, ['chat_id'])
+    if repository.add_user(user_model(chat_id=chat_id)):
+        counters.inc('users')
     
     message_id = uuid.uuid4().hex
 
-    db_roaming['message'].insert(message_model(
+    row_id = repository.add_message(message_model(
         message_id=message_id,
         chat_id=chat_id,
         published=False,
         data=update.message.voice.file_id,
         origin=update.message.from_user.mention_html()
     ))
+    counters.inc('notes_recorded')
     if (chat_id == bot_config['developer_chat_id']):
         update.message.reply_text(text=f'{update.message.voice.file_id}')
-    replace_option = len(list(db_roaming['message'].find(chat_id=chat_id, topic='general', published=True))) >= 1
+    replace_option = repository.has_published_message(chat_id, topic='general')
 
     keyboard = [
-        ([InlineKeyboardButton('Send as reaction', callback_data=f'RM{message_id}')] if 'liked_message_id' in context.chat_data else []),
+        ([InlineKeyboardButton('Send as reaction', callback_data=callbacks.encode(callbacks.REACT, row_id))] if 'liked_message_id' in context.chat_data else []),
         [
-            InlineKeyboardButton('Discard', callback_data=f'DM{message_id}'),
-            InlineKeyboardButton(f'{"Replace my message" if replace_option else "Publish"}', callback_data=f'SM{message_id}'),
+            InlineKeyboardButton('Discard', callback_data=callbacks.encode(callbacks.DISCARD, row_id)),
+            InlineKeyboardButton(f'{"Replace my message" if replace_option else "Publish"}', callback_data=callbacks.encode(callbacks.SAVE, row_id)),
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -307,12 +398,10 @@ def handle_voice_msg(update:Update, context: CallbackContext):
     )
     update.message.reply_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
-def discard_message(update: Update, context: CallbackContext):
+def discard_message(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    content = query.data[2:]
 
     text = (
         "Your message was not published.\n"
@@ -320,89 +409,175 @@ def discard_message(update: Update, context: CallbackContext):
     )
     context.bot.send_message(chat_id=chat_id, text=text, parse_mode = ParseMode.HTML)
 
-def save_message(update: Update, context: CallbackContext):
+def save_message(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    message_id = query.data[2:]
+    message_id = message['message_id']
 
-    message = dict(published=True, message_id=message_id, chat_id=chat_id)
-    db_roaming['message'].update(message, ['message_id', 'chat_id'])
+    message = repository.publish_message(message_id, chat_id)
+    if not message: return
+    publish_note(message)
+    counters.inc('notes_published')
 
     text = (
         "Your message can now be discovered.\n"
         "<b>Start listening to others' messages to find a match:</b>"
     )
-    context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('Start', callback_data=f'M')]]), parse_mode=ParseMode.HTML) 
+    context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('Start', callback_data=callbacks.encode(callbacks.MORE))]]), parse_mode=ParseMode.HTML) 
 
-def react_message(update: Update, context: CallbackContext):
+def react_message(update: Update, context: CallbackContext, message):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    message_id = query.data[2:]
+    message_id = message['message_id']
 
     liked_message_id = context.chat_data.get('liked_message_id',None)
     if not liked_message_id: return
 
-    message = db_roaming['message'].find_one(message_id=message_id, chat_id=chat_id, published=False)
-    message['topic'] = liked_message_id
-    db_roaming['message'].update(message, ['published','message_id', 'chat_id'])
+    message = repository.set_message_topic(message_id, chat_id, liked_message_id)
+    if not message:
+        raise(Exception("invalid message_id"))
+    publish_note(message)
+    counters.inc('reactions')
     
-    liked_message = db_roaming['message'].find_one(message_id=liked_message_id)
+    liked_message = repository.get_message(liked_message_id)
 
     text = (
         'Here is how they react to your message:'
     )
-    context.bot.send_message(liked_message['chat_id'], text)
-    
-    keyboard = [[
-        InlineKeyboardButton('Next', callback_data=f'N{message_id}'),
-        InlineKeyboardButton('Like', callback_data=f'Y{message_id}')
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_voice(liked_message['chat_id'], message['data'], reply_markup=reply_markup)
-
-    text = (
+    reply_markup = note_keyboard(message)
+    reaction_text = (
         "Your reaction was delivered directly\n"
     )
-    context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('Check out more messages', callback_data=f'M')]])) 
+    send_concurrently(
+        [
+            partial(context.bot.send_message, liked_message['chat_id'], text),
+            partial(voices.send, context.bot, liked_message['chat_id'], message['data'], reply_markup=reply_markup),
+        ],
+        [partial(context.bot.send_message, chat_id=chat_id, text=reaction_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('Check out more messages', callback_data=callbacks.encode(callbacks.MORE))]]))],
+    )
 
 def stats(update: Update, context: CallbackContext):
     if update.effective_chat.id != bot_config['developer_chat_id']: return
-    text = (
-        f"# of users: {len(db_roaming['user'])}\n"
-        f"# of message: {len(db_roaming['message'])}\n"
-        f"# of ratings: {len(db_roaming['rating'])}\n"
+    totals = counters.totals()
+    hourly = counters.hourly(24)
+    text = ""
+    for name in ['users', 'notes_recorded', 'notes_published', 'reactions', 'likes', 'dislikes', 'matches']:
+        text += f"# of {name}: {totals.get(name, 0)} (+{sum(hourly.get(name, dict()).values())} in 24h)\n"
+    text += "\nper hour (swipes, likes, matches, published):\n"
+    hours = sorted(set(bucket for counts in hourly.values() for bucket in counts), reverse=True)[:6]
+    for hour in hours:
+        count = lambda name: hourly.get(name, dict()).get(hour, 0)
+        text += (
+            f"{datetime.datetime.fromtimestamp(hour, timezone.utc):%H:00}: {count('likes') + count('dislikes')}, "
+            f"{count('likes')}, {count('matches')}, {count('notes_published')}\n"
+        )
+    text += "\n"
+    outbox_stats = outbox.stats()
+    text += (
+        f"outbox: {outbox_stats['depth']} queued, {outbox_stats['sent']} sent, {outbox_stats['failed']} failed, "
+        f"{outbox_stats['retried']} retried, {outbox_stats['coalesced']} coalesced\n"
+        f"outbox latency: p50 {outbox_stats['latency_p50']:.2f}s, max {outbox_stats['latency_max']:.2f}s\n"
+    )
+    text += "\nhandlers (count, mean, max):\n"
+    for labels, count, mean, maximum in sorted(metrics.registry.summary('unisono_handler_seconds'), key=lambda s: -s[2]):
+        text += f"{labels['handler']}: {count}, {mean*1000:.0f}ms, {maximum*1000:.0f}ms\n"
+    queries = metrics.registry.summary('unisono_db_query_seconds')
+    db_count = sum(count for _, count, _, _ in queries)
+    db_time = sum(count * mean for _, count, mean, _ in queries)
+    text += f"\ndb: {db_count} queries, {db_time:.1f}s total\n"
+    for labels, count, mean, maximum in sorted(queries, key=lambda s: -s[1] * s[2])[:5]:
+        text += f"{labels['operation']} {labels['table']}: {count}, {mean*1000:.1f}ms, {maximum*1000:.0f}ms\n"
+    text += "\nvoices (count, mean, max):\n"
+    for labels, count, mean, maximum in metrics.registry.summary('unisono_voice_send_seconds'):
+        text += f"{labels['asset']}: {count}, {mean*1000:.0f}ms, {maximum*1000:.0f}ms\n"
+    text += (
+        f"cache hits: users {repository.users.hits}/{repository.users.hits + repository.users.misses}, "
+        f"messages {repository.messages.hits}/{repository.messages.hits + repository.messages.misses}\n"
+    )
+    text += (
+        f"\nhandler errors: {metrics.registry.total('unisono_handler_errors_total')}\n"
+        f"bot api errors: {metrics.registry.total('unisono_bot_api_errors_total')}\n"
     )
     update.message.reply_text(text=text)
 
+def profile(update: Update, context: CallbackContext):
+    """/profile [updates | <seconds>s | stop], profile the next handler calls and report the top functions."""
+    if update.effective_chat.id != bot_config['developer_chat_id']: return
+    chat_id = update.effective_chat.id
+    argument = context.args[0].lower() if context.args else '100'
+    if argument == 'stop':
+        profiling.profiler.stop()
+        return
+    try:
+        if argument.endswith('s'):
+            updates, seconds = None, float(argument[:-1])
+        else:
+            updates, seconds = int(argument), bot_config.get('profile_max_seconds', 300)
+    except ValueError:
+        update.message.reply_text("usage: /profile [updates | <seconds>s | stop]")
+        return
+    def send_report(report):
+        text = html.escape(report)[:4000]
+        context.bot.send_message(chat_id=chat_id, text=f'<pre>{text}</pre>', parse_mode=ParseMode.HTML)
+    if not profiling.profiler.start(send_report, updates=updates, seconds=seconds):
+        update.message.reply_text("profiling is already running, /profile stop ends it")
+        return
+    update.message.reply_text(f"profiling {f'the next {updates} updates' if updates else f'for {seconds:g}s'}...")
+
+def slow_updates(update: Update, context: CallbackContext):
+    if update.effective_chat.id != bot_config['developer_chat_id']: return
+    entries = list(profiling.slow_log.entries)
+    if not entries:
+        update.message.reply_text(f"no update took longer than {profiling.slow_log.threshold}s")
+        return
+    text = "\n\n".join(profiling.format_slow_update(entry) for entry in entries[-10:])
+    update.message.reply_text(text=text[-4000:])
+
 def reset_ratings(update: Update, context: CallbackContext):
     if update.effective_chat.id != bot_config['developer_chat_id']: return
+    rating_writer.discard()
     db_roaming['rating'].delete()
+    db_roaming['user_like'].delete()
+    db_roaming['user_match'].delete()
+    db_roaming['rating_archive'].delete()
+    db_roaming['user_seen'].delete()
+    db_roaming['example'].delete()
+    counters.reset(['likes', 'dislikes', 'matches'])
+    example_pool.reset()
+    candidate_index.reset()
+    feed.reset()
+    announce('reset')
     logger.info("ratings database reset")
     update.message.reply_text("done")
 
 def reset_database(update: Update, context: CallbackContext):
     if update.effective_chat.id != bot_config['developer_chat_id']: return
+    rating_writer.discard()
+    counters.reset([name for name, _ in schema.counter_totals])
     for table in db_roaming.tables:
+        if table == 'schema_version': continue
         db_roaming[table].delete()
+    persistence.reset(context.dispatcher)
+    repository.reset()
+    example_pool.reset()
+    candidate_index.reset()
+    feed.reset()
+    announce('reset', 'database')
     logger.info("database reset")
     update.message.reply_text("done")
 
 def start(update: Update, context: CallbackContext):
-    user = db_roaming['user'].find_one(chat_id=update.effective_chat.id)
-    if not user:
-        user = user_model(chat_id=update.effective_chat.id)
-        db_roaming['user'].upsert(user, ['chat_id'])
+    if repository.add_user(user_model(chat_id=update.effective_chat.id)):
+        counters.inc('users')
     tg_user = update.message.from_user
     text = (
         f'Nice to hear from you {tg_user.first_name} {tg_user.last_name}\n'
     )
     update.message.reply_text(text=text, parse_mode=ParseMode.HTML)
 
-    context.bot.send_voice(chat_id=update.effective_chat.id, voice=bot_config['welcome_message'])
+    voices.send(context.bot, update.effective_chat.id, name='welcome_message')
 
     text = (
         f'Want to find someone you are on the same wavelength with?\n'
@@ -417,24 +592,16 @@ def start(update: Update, context: CallbackContext):
         'Start right now. Tell me what excites you or Answer a random prompt:'
     )
     keyboard = [[
-        InlineKeyboardButton('Give me a random prompt', callback_data=f'P')
+        InlineKeyboardButton('Give me a random prompt', callback_data=callbacks.encode(callbacks.PROMPT, 0))
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup, parse_mode = ParseMode.HTML)
 
-def random_prompt(update: Update, context: CallbackContext):
+def random_prompt(update: Update, context: CallbackContext, count):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    content = query.data[1:]
-    
-    count = 0
-    try:
-        count = max(int(content.lower()),0)
-    except (ValueError):
-        count = 0
 
     if count == 0:
         text = (
@@ -442,7 +609,7 @@ def random_prompt(update: Update, context: CallbackContext):
             f'<i>{random.choice(prompts)}</i>'
         )
         keyboard = [[
-            InlineKeyboardButton('Another one', callback_data=f'P{count+1}')
+            InlineKeyboardButton('Another one', callback_data=callbacks.encode(callbacks.PROMPT, count+1))
         ]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode = ParseMode.HTML, reply_markup=reply_markup)
@@ -452,7 +619,7 @@ def random_prompt(update: Update, context: CallbackContext):
             f'<i>{random.choice(prompts)}</i>'
         )
         keyboard = [[
-            InlineKeyboardButton('Another one, please', callback_data=f'P{count+1}')
+            InlineKeyboardButton('Another one, please', callback_data=callbacks.encode(callbacks.PROMPT, count+1))
         ]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode = ParseMode.HTML, reply_markup=reply_markup)
@@ -463,17 +630,13 @@ def random_prompt(update: Update, context: CallbackContext):
             f'If you like, you can hear My thoughts about this topic and Some examples by others.'
         )
         keyboard = [[
-            InlineKeyboardButton('More tips please for my first voice message', callback_data=f'F')
+            InlineKeyboardButton('More tips please for my first voice message', callback_data=callbacks.encode(callbacks.HELP))
         ]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode = ParseMode.HTML, reply_markup=reply_markup)
 
 def send_first_message_help(update: Update, context: CallbackContext):
     if update.effective_chat.id != bot_config['developer_chat_id']: return
-    user_ids = set([user['chat_id'] for user in db_roaming['user'].find()])
-    message_user_ids = set([msg['chat_id'] for msg in db_roaming['message'].find()])
-    user_ids -= message_user_ids
-
     text = (
         f'<b>I\'m very grateful for you showing interest in Unisono!</b>\n'
         f'Though without a voice message how can others get to know you?\n'
@@ -482,44 +645,32 @@ def send_first_message_help(update: Update, context: CallbackContext):
         f'In the meantime you can hear my thoughts about this topic or some examples:'
     )
     keyboard = [[
-        InlineKeyboardButton('Tips for my first voice message', callback_data=f'F')
+        InlineKeyboardButton('Tips for my first voice message', callback_data=callbacks.encode(callbacks.HELP))
     ]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    for user_id in user_ids:
-        context.bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-    context.bot.send_message(update.effective_chat.id, f'Done.\nMessage sent to {len(user_ids)} user(s).')
+    broadcast_id = broadcaster.create_inactive_users_broadcast('first_message_help', text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    recipients = broadcaster.progress(broadcast_id)['pending']
+    context.bot.send_message(update.effective_chat.id, f'Sending to {recipients} user(s)...')
+    broadcaster.start(context.bot, broadcast_id, update.effective_chat.id)
 
 def first_message_help(update: Update, context: CallbackContext):
     query=update.callback_query
-    query.answer()
     
     chat_id = query.message.chat.id
-    content = query.data[1:]
     text = (
         f"Why does my voice sound unfamiliar to me when played back?\n"
     )
     context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
-    context.bot.send_voice(chat_id, bot_config['first_message_help'])
+    voices.send(context.bot, chat_id, name='first_message_help')
 
-    ratings = db_roaming['rating'].find(from_id={'not':chat_id}, to_id={'not':chat_id}, rating=1)
-    message_ids = set([msg['message_id'] for msg in ratings])
-    if len(message_ids):
+    examples = example_pool.sample(chat_id, k=2)
+    if examples:
         text = (
             f"Curious what others' messages are about?:\n"
         )
-        # send first example message
         context.bot.send_message(chat_id, text)
-        random_msg_id = random.choice(list(message_ids))
-        random_msg = db_roaming['message'].find_one(message_id=random_msg_id)
-        if random_msg:
-            context.bot.send_voice(chat_id, voice=random_msg['data'])
-        message_ids.remove(random_msg_id)
-    #send second example message
-    if len(message_ids):
-        random_msg_id = random.choice(list(message_ids))
-        random_msg = db_roaming['message'].find_one(message_id=random_msg_id)
-        if random_msg:
-            context.bot.send_voice(chat_id, voice=random_msg['data'])
+    for example in examples:
+        voices.send(context.bot, chat_id, example['data'])
     
     text = (
         "Ready for your first message?\n"
@@ -527,9 +678,21 @@ def first_message_help(update: Update, context: CallbackContext):
     )
     context.bot.send_message(chat_id, text)
 
-def main() -> None:
+def create_bot(workers):
+    return QueuedBot(
+        bot_config['bot_token'],
+        # e.g. the local stand-in from fake_telegram.py
+        base_url=bot_config.get('bot_api_url'),
+        base_file_url=bot_config.get('bot_api_file_url'),
+        request=metrics.TimedRequest(con_pool_size=workers + bot_config.get('outbox_workers', 8) + 4),
+        outbox=outbox,
+    )
+
+def create_updater() -> Updater:
     # Create the Updater and pass it your bot's token.
-    updater = Updater(bot_config['bot_token'])
+    # Its dispatcher is run from ChatLanes, see create_intake, so the handlers run in order per chat.
+    workers = bot_config.get('workers', 8)
+    updater = Updater(bot=create_bot(workers), workers=workers, persistence=persistence)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
@@ -541,29 +704,155 @@ def main() -> None:
         dispatcher.add_handler(CommandHandler('reset_ratings', reset_ratings))
         dispatcher.add_handler(CommandHandler('reset_database', reset_database))
     dispatcher.add_handler(CommandHandler('stats', stats))
+    dispatcher.add_handler(CommandHandler('profile', profile))
+    dispatcher.add_handler(CommandHandler('slow', slow_updates))
     dispatcher.add_handler(CommandHandler('send_first_message_help', send_first_message_help))
-    dispatcher.add_handler(CallbackQueryHandler(rating_no, pattern='^N'))
-    dispatcher.add_handler(CallbackQueryHandler(rating_yes, pattern='^Y'))
-    dispatcher.add_handler(CallbackQueryHandler(next_message, pattern='^M'))
-    dispatcher.add_handler(CallbackQueryHandler(first_message_help, pattern='^F'))
-    dispatcher.add_handler(CallbackQueryHandler(random_prompt, pattern='^P'))
-    dispatcher.add_handler(CallbackQueryHandler(save_message, pattern='^SM'))
-    dispatcher.add_handler(CallbackQueryHandler(discard_message, pattern='^DM'))
-    dispatcher.add_handler(CallbackQueryHandler(react_message, pattern='^RM'))
-    dispatcher.add_handler(CallbackQueryHandler(like_reaction_yes, pattern='^LRY'))
+    # ...and the buttons, all through one handler
+    router = CallbackRouter(repository)
+    router.add(callbacks.NEXT, rating_no, callbacks.NOTE)
+    router.add(callbacks.LIKE, rating_yes, callbacks.NOTE)
+    router.add(callbacks.MORE, next_message)
+    router.add(callbacks.HELP, first_message_help)
+    router.add(callbacks.PROMPT, random_prompt, callbacks.COUNT)
+    router.add(callbacks.SAVE, save_message, callbacks.RECORDING)
+    router.add(callbacks.DISCARD, discard_message, callbacks.RECORDING)
+    router.add(callbacks.REACT, react_message, callbacks.RECORDING)
+    router.add(callbacks.REACT_LIKE, like_reaction_yes, callbacks.NOTE)
+    dispatcher.add_handler(CallbackQueryHandler(router))
     dispatcher.add_handler(MessageHandler(Filters.text, handle_msg))
     dispatcher.add_handler(MessageHandler(Filters.voice, handle_voice_msg))
 
+    # Record how long each handler takes
+    metrics.instrument_dispatcher(dispatcher)
+
     # ...and the error handler
     dispatcher.add_error_handler(error_handler)
+    return updater
+
+def create_intake(lanes) -> Updater:
+    """Updater that receives the updates and hands them to `lanes`."""
+    intake = Updater(bot=create_bot(1), workers=1)
+    intake.dispatcher.add_handler(TypeHandler(Update, lanes.forward))
+    return intake
+
+def start_webhook(updater: Updater) -> None:
+    # Telegram pushes updates to bot_config['webhook_url'], which a reverse proxy forwards to
+    # the local server. The secret is part of the path so that only Telegram knows where to post.
+    url_path = bot_config.get('webhook_path', 'telegram').strip('/')
+    if bot_config.get('webhook_secret_token'):
+        url_path = f"{url_path}/{bot_config['webhook_secret_token']}"
+    updater.start_webhook(
+        listen=bot_config.get('webhook_listen', '127.0.0.1'),
+        port=bot_config.get('webhook_port', 8443),
+        url_path=url_path,
+        webhook_url=f"{bot_config['webhook_url'].rstrip('/')}/{url_path}",
+        max_connections=bot_config.get('webhook_max_connections', 40),
+    )
+
+def start_updates(updater: Updater) -> None:
+    if bot_config.get('webhook_url'):
+        start_webhook(updater)
+    else:
+        updater.start_polling()
+
+def run_worker(number, count, updates, events):
+    """Handle the updates the intake process routes to worker `number` of `count`."""
+    global cluster_events, worker_number
+    cluster_events, worker_number = events, number
+    # the intake process decides when to stop, after passing on all updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # all workers share the bot's flood limit
+    outbox.bucket = TokenBucket(bot_config.get('outbox_rate', 30) / count)
+    updater = create_updater()
+    dispatcher = updater.dispatcher
+    # the updates of a chat are handled in the order they arrived, different chats concurrently
+    lanes = ChatLanes(dispatcher.process_update, bot_config.get('workers', 8), stride=count)
+
+    if bot_config.get('metrics_port'):
+        metrics.start_http_server(bot_config.get('metrics_listen', '127.0.0.1'), bot_config['metrics_port'] + 1 + number)
+    # background jobs run once, in the first worker
+    if number == 0:
+        voices.prewarm(updater.bot)
+        rating_compactor.start()
+        broadcaster.resume(updater.bot, bot_config['developer_chat_id'])
+    example_pool.start(compute=number == 0)
+
+    lanes.start()
+    intake_pid = os.getppid()
+    while True:
+        try:
+            kind, payload = updates.get(timeout=1)
+        except queue.Empty:
+            # the intake process died without stopping us
+            if os.getppid() != intake_pid: break
+            continue
+        if kind == 'update':
+            lanes.put(Update.de_json(payload, updater.bot))
+        elif kind == 'publish':
+            repository.messages.pop(payload['message_id'])
+            feed.publish(payload)
+        elif kind == 'reset':
+            if payload == 'database':
+                persistence.reset(dispatcher)
+            repository.reset()
+            example_pool.reset()
+            candidate_index.reset()
+            feed.reset()
+        elif kind == 'stop':
+            break
+    lanes.stop()
+    dispatcher.stop()
+    persistence.flush()
+    counters.flush()
+    rating_writer.flush()
+
+def main_cluster(count) -> None:
+    """Receive updates in this process and handle them in `count` worker processes."""
+    intake = Intake(run_worker, count)
+    intake.start()
+    updater = Updater(bot=create_bot(1), workers=1)
+    updater.dispatcher.add_handler(TypeHandler(Update, intake.forward))
+    if bot_config.get('metrics_port'):
+        metrics.start_http_server(bot_config.get('metrics_listen', '127.0.0.1'), bot_config['metrics_port'])
+    start_updates(updater)
+    updater.idle()
+    intake.stop()
+
+def main() -> None:
+    schema.migrate(db_roaming)
+    # worker_processes > 0 spreads the handlers over that many processes, by chat
+    if bot_config.get('worker_processes'):
+        main_cluster(bot_config['worker_processes'])
+        return
+    updater = create_updater()
+    # the updates of a chat are handled in the order they arrived, different chats concurrently
+    lanes = ChatLanes(updater.dispatcher.process_update, bot_config.get('workers', 8))
+    intake = create_intake(lanes)
+
+    # Prometheus metrics on http://metrics_listen:metrics_port/metrics
+    if bot_config.get('metrics_port'):
+        metrics.start_http_server(bot_config.get('metrics_listen', '127.0.0.1'), bot_config['metrics_port'])
+
+    voices.prewarm(updater.bot)
+    rating_compactor.start()
+    example_pool.start()
+
+    # Pick up broadcasts interrupted by the last shutdown
+    broadcaster.resume(updater.bot, bot_config['developer_chat_id'])
 
     # Start the Bot
-    updater.start_polling()
+    lanes.start()
+    start_updates(intake)
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # start_polling() and start_webhook() are non-blocking and will stop the bot gracefully.
+    intake.idle()
+    lanes.stop()
+    persistence.flush()
+    counters.flush()
+    rating_writer.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import text
+from telegram.error import BadRequest, TelegramError
+
+import metrics
+from repository import LRUCache
+
+logger = logging.getLogger(__name__)
+
+metrics.registry.describe('unisono_voice_send_seconds', 'Time to send a voice message, per asset')
+
+insert_query = text("""
+INSERT INTO voice_asset (name, configured, file_id, utc_timestamp)
+VALUES (:name, :configured, :file_id, :utc_timestamp);
+""")
+update_query = text("""
+UPDATE voice_asset SET configured = :configured, file_id = :file_id, utc_timestamp = :utc_timestamp
+WHERE name = :name;
+""")
+
+class VoiceAssets:
+    """Sends voice messages by file_id, using the latest file_id Telegram returned for each.
+
+    Named assets are the voices from bot_config that every new user gets. prewarm()
+    checks their file_ids and keeps a copy of the configured audio in `cache_dir`, which
+    is uploaded instead if Telegram rejects the file_id; the file_id of that upload is
+    stored in the voice_asset table and used from then on. Notes have no local copy, a rejected note is
+    an error as before.
+    """
+
+    def __init__(self, db, assets, cache_dir='voice_cache', cache_size=10000):
+        self.db = db
+        self.assets = dict(assets)            # name -> file_id in bot_config
+        self.cache_dir = cache_dir
+        self.file_ids = LRUCache(cache_size)  # name or configured file_id -> latest file_id
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def _load(self):
+        with self.lock:
+            if self.loaded: return
+            for row in self.db['voice_asset'].all():
+                # a file_id stored for an older configuration doesn't count
+                if self.assets.get(row['name']) == row['configured']:
+                    self.file_ids.put(row['name'], row['file_id'])
+            self.loaded = True
+
+    def path(self, name):
+        # named after the configured file_id too, so a new voice in bot_config gets a new copy
+        configured = hashlib.sha1(self.assets[name].encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f'{name}-{configured}.ogg')
+
+    def file_id(self, voice=None, name=None):
+        self._load()
+        return self.file_ids.get(name or voice) or (self.assets[name] if name else voice)
+
+    def send(self, bot, chat_id, voice=None, name=None, **kwargs):
+        """Send the voice with file_id `voice`, or the named asset, and return the message."""
+        file_id = self.file_id(voice, name)
+        started = time.perf_counter()
+        uploaded = False
+        try:
+            try:
+                message = bot.send_voice(chat_id=chat_id, voice=file_id, **kwargs)
+            except BadRequest as e:
+                if not name or not os.path.exists(self.path(name)): raise
+                logger.warning(f"file_id of {name} was rejected ({e}), uploading the local copy")
+                with open(self.path(name), 'rb') as f:
+                    message = bot.send_voice(chat_id=chat_id, voice=f.read(), **kwargs)
+                uploaded = True
+        finally:
+            metrics.registry.observe('unisono_voice_send_seconds', time.perf_counter() - started, asset=name or 'note')
+        if message and message.voice and message.voice.file_id != file_id:
+            self.file_ids.put(name or voice, message.voice.file_id)
+            if uploaded:
+                self._store(name, message.voice.file_id)
+        return message
+
+    def _store(self, name, file_id):
+        """Keep the file_id of a fresh upload across restarts and for the other processes."""
+        params = dict(name=name, configured=self.assets[name], file_id=file_id, utc_timestamp=time.time())
+        with self.db as tx:
+            if not tx.executable.execute(update_query, params).rowcount:
+                tx.executable.execute(insert_query, params)
+
+    def _remove_old_copies(self, name):
+        current = os.path.basename(self.path(name))
+        for entry in os.listdir(self.cache_dir):
+            if entry != current and entry.startswith(f'{name}-') and len(entry) == len(current):
+                os.remove(os.path.join(self.cache_dir, entry))
+
+    def prewarm(self, bot):
+        """Check the file_ids of the named assets and download the copies missing in cache_dir."""
+        self._load()
+        for name in self.assets:
+            try:
+                telegram_file = bot.get_file(self.file_id(name=name))
+                if os.path.exists(self.path(name)): continue
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # another process may be reading the copy, replace it in one step
+                telegram_file.download(custom_path=f'{self.path(name)}.part')
+                os.replace(f'{self.path(name)}.part', self.path(name))
+                self._remove_old_copies(name)
+            except TelegramError as e:
+                if os.path.exists(self.path(name)):
+                    logger.warning(f"file_id of {name} can't be fetched ({e}), its local copy will be uploaded")
+                else:
+                    logger.error(f"file_id of {name} can't be fetched ({e}) and there is no local copy")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class BufferedWriter:
+    """Changes collected in memory and written by a background thread.
+
+    Owners add to `pending` while holding `condition` and call added(). The thread calls
+    flush() `delay` seconds after the first change of a batch, or as soon as the batch
+    holds `max_batch` changes. flush() hands the batch to `write`, which writes it in
+    one transaction. If that fails the batch is given back to `requeue` together with
+    the changes made meanwhile, and written with the next flush.
+
+    `new` creates an empty batch, `write_lock` is held while one is written.
+    """
+
+    def __init__(self, name, write, requeue, new=dict, delay=1, max_batch=None):
+        self.name = name
+        self.write = write
+        self.requeue = requeue  # (failed batch, pending) -> merges the batch into pending
+        self.new = new
+        self.delay = delay
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.pending = new()
+        self.first_added = None
+        self.thread = None
+
+    def added(self):
+        """Call with `condition` held after adding to `pending`."""
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+        if self.first_added is None:
+            self.first_added = time.monotonic()
+            self.condition.notify()
+        elif self.max_batch and len(self.pending) >= self.max_batch:
+            self.condition.notify()
+
+    def flush(self):
+        """Write all changes added so far."""
+        with self.write_lock:
+            with self.condition:
+                batch, self.pending = self.pending, self.new()
+                self.first_added = None
+            if not batch: return
+            try:
+                self.write(batch)
+            except Exception:
+                with self.condition:
+                    self.requeue(batch, self.pending)
+                    if self.first_added is None:
+                        self.first_added = time.monotonic()
+                raise
+
+    def discard(self):
+        """Drop the changes not written yet."""
+        with self.write_lock:
+            with self.condition:
+                self.pending = self.new()
+                self.first_added = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # collect the changes of the next `delay` seconds into the same batch
+                while not self.max_batch or len(self.pending) < self.max_batch:
+                    remaining = (self.first_added or 0) + self.delay - time.monotonic()
+                    if remaining <= 0: break
+                    self.condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f"{self.name}: writing failed")
+                time.sleep(self.delay)